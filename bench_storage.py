@@ -0,0 +1,213 @@
+"""
+bench_storage.py — микробенчмарк слоя хранения (db.py и db2.py).
+
+Создаёт синтетическую базу (N пользователей рассылки, M заметок у U пользователей)
+и меряет операции в один поток и в T потоков: задержки p50/p95/p99, операций в секунду
+и ожидание блокировок пула (storage.ConnectionPool: очередь за читателем и за писателем).
+Результат — JSON, чтобы сравнивать прогоны между коммитами.
+
+Пример:
+    python bench_storage.py --users 50000 --notes 1000000 --threads 8 --out bench_output.txt
+
+База создаётся во временной папке (или --db PATH; существующая не перезаписывается —
+данные дозаливаются только при --fill). Одинаковый --seed даёт одинаковые данные.
+"""
+
+from __future__ import annotations
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+from typing import Callable
+
+import storage
+
+WORDS = ("заметка купить молоко встреча завтра позвонить маме отчёт проект идея книга фильм "
+         "спорт врач оплатить счёт подарок день рождения python sqlite telegram бот "
+         "exam deadline meeting travel ticket recipe garden music").split()
+SIGNS = ("aries taurus gemini cancer leo virgo libra scorpio sagittarius capricorn aquarius pisces").split()
+
+OPS = ("add_note", "list_notes", "find_notes", "list_due_users", "mark_sent_today")
+
+
+# ---------- синтетические данные ----------
+def _fill(db, db2, *, users: int, notes: int, note_users: int, rng: random.Random) -> float:
+    """Заливает данные одной транзакцией на пачку; вернёт секунды. Триггеры (FTS, счётчики) работают как в бою."""
+    t0 = time.perf_counter()
+    batch = 50_000
+    with db2._write() as conn:
+        rows = [(uid, rng.choice(SIGNS), rng.randrange(24), int(rng.random() < 0.9), None)
+                for uid in range(1, users + 1)]
+        conn.executemany(
+            "INSERT OR IGNORE INTO users(user_id, sign, notify_hour, subscribed, last_sent_date) VALUES (?,?,?,?,?)",
+            rows
+        )
+    done = 0
+    while done < notes:
+        n = min(batch, notes - done)
+        rows = [(rng.randint(1, note_users),
+                 " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))),
+                 f"-{rng.randrange(90 * 24 * 60)} minutes")
+                for _ in range(n)]
+        with db._write() as conn:
+            conn.executemany("INSERT INTO notes(user_id, text, created_at) VALUES (?, ?, datetime('now', ?))", rows)
+        done += n
+        print(f"  notes: {done}/{notes}", file=sys.stderr)
+    return time.perf_counter() - t0
+
+
+# ---------- замеры ----------
+def _pct(vals: list[float], p: float) -> float:
+    k = max(0, min(len(vals) - 1, math.ceil(p / 100 * len(vals)) - 1))
+    return round(vals[k], 3)
+
+
+def _lock_wait(before: dict, after: dict) -> dict:
+    return {
+        "reader_waits": after["waits"] - before["waits"],
+        "reader_wait_ms": round(after["wait_ms"] - before["wait_ms"], 3),
+        "writer_waits": after["writer_waits"] - before["writer_waits"],
+        "writer_wait_ms": round(after["writer_wait_ms"] - before["writer_wait_ms"], 3),
+    }
+
+
+def _run(name: str, fn: Callable[[random.Random], object], *, n: int, threads: int,
+         seed: int, pool_stats: Callable[[], dict]) -> dict:
+    per_thread = max(1, n // threads)
+    lat: list[float] = []
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def worker(i: int) -> None:
+        rng = random.Random(seed * 1000 + i)
+        local = []
+        start.wait()
+        for _ in range(per_thread):
+            t0 = time.perf_counter()
+            fn(rng)
+            local.append((time.perf_counter() - t0) * 1000)
+        with lock:
+            lat.extend(local)
+
+    before = pool_stats()
+    t0 = time.perf_counter()
+    ts = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return {
+        "op": name, "threads": threads, "n": len(lat),
+        "wall_s": round(wall, 3), "ops_per_s": round(len(lat) / wall, 1),
+        "mean_ms": round(sum(lat) / len(lat), 3),
+        "p50_ms": _pct(lat, 50), "p95_ms": _pct(lat, 95), "p99_ms": _pct(lat, 99), "max_ms": round(lat[-1], 3),
+        **_lock_wait(before, pool_stats()),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=50_000, help="пользователей рассылки (db2.users)")
+    ap.add_argument("--notes", type=int, default=1_000_000, help="заметок всего (db.notes)")
+    ap.add_argument("--note-users", type=int, default=None, help="у скольких пользователей заметки (по умолчанию --users)")
+    ap.add_argument("--threads", type=int, default=8, help="потоков в параллельном прогоне")
+    ap.add_argument("--ops", type=int, default=2000, help="операций на замер")
+    ap.add_argument("--only", default=",".join(OPS), help="какие операции мерить, через запятую")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", default=None, help="путь к базе (по умолчанию — во временной папке)")
+    ap.add_argument("--fill", action="store_true", help="дозалить данные в существующую --db")
+    ap.add_argument("--out", default="-", help="куда писать JSON ('-' — stdout)")
+    args = ap.parse_args(argv)
+
+    tmpdir = None
+    if args.db is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="bench_storage_")
+        args.db = os.path.join(tmpdir.name, "bench.db")
+    fresh = not os.path.exists(args.db)
+    # модули читают DB_PATH при импорте; config2 требует TOKEN, но в сеть бенчмарк не ходит
+    os.environ["DB_PATH"] = args.db
+    os.environ.setdefault("TOKEN", "bench")
+    import db
+    import db2
+
+    db.init_db()
+    db2.init_db()
+    note_users = args.note_users or args.users
+    setup_s = 0.0
+    if fresh or args.fill:
+        print(f"Filling {args.db}: {args.users} users, {args.notes} notes...", file=sys.stderr)
+        setup_s = _fill(db, db2, users=args.users, notes=args.notes, note_users=note_users,
+                        rng=random.Random(args.seed))
+    with db._read() as conn:
+        n_notes = conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+        n_users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    today = date.today().isoformat()
+    ops: dict[str, Callable[[random.Random], object]] = {
+        "add_note": lambda r: db.add_note(r.randint(1, note_users), "bench " + r.choice(WORDS)),
+        "list_notes": lambda r: db.list_notes(r.randint(1, note_users)),
+        "find_notes": lambda r: db.find_notes(r.randint(1, note_users), r.choice(WORDS)),
+        "list_due_users": lambda r: db2.list_due_users(today, r.randrange(24)),
+        "mark_sent_today": lambda r: db2.mark_sent_today(r.randint(1, args.users), today),
+    }
+    selected = [o.strip() for o in args.only.split(",") if o.strip()]
+    unknown = [o for o in selected if o not in ops]
+    if unknown:
+        ap.error(f"неизвестные операции: {', '.join(unknown)}")
+
+    results = []
+    for name in selected:
+        for threads in (1, args.threads):
+            print(f"  {name} x{threads}...", file=sys.stderr)
+            results.append(_run(name, ops[name], n=args.ops, threads=threads, seed=args.seed,
+                                pool_stats=db.pool_stats))
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "users": n_users, "notes": n_notes, "note_users": note_users,
+            "threads": args.threads, "ops": args.ops, "seed": args.seed,
+            "pool_size": storage.DEFAULT_POOL_SIZE,
+            "write_behind": db.write_queue_stats() is not None,
+            "setup_s": round(setup_s, 3),
+        },
+        "results": results,
+    }
+    body = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out == "-":
+        print(body)
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(body + "\n")
+    db.disable_write_behind()
+    storage.close_all()
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
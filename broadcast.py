@@ -0,0 +1,171 @@
+"""
+broadcast.py — параллельная рассылка с учётом лимитов Telegram.
+
+  - пул из N потоков-отправителей: один медленный send_message не задерживает остальных;
+  - глобальный token bucket (по умолчанию ~25 сообщений/с при лимите Telegram 30/с);
+  - минимальный интервал между сообщениями в один чат (лимит ~1 сообщение/с на чат);
+  - 429 Too Many Requests: ставим всю рассылку на паузу на retry_after и повторяем;
+  - отчёт по прогону: отправлено / ошибок / длительность / сообщений в секунду.
+"""
+
+from __future__ import annotations
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RATE = 25.0          # сообщений в секунду на бота
+DEFAULT_PER_CHAT_S = 1.0     # минимальный интервал между сообщениями в один чат
+MAX_RETRIES = 3
+FAILED_IDS_SHOWN = 20         # сколько чатов с ошибкой показывать в отчёте
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: acquire() блокирует, пока не появится токен."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Глобальная пауза (ответ 429 с retry_after)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def acquire(self) -> float:
+        """Забирает токен; вернёт, сколько секунд пришлось ждать."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return waited
+                    delay = (1.0 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class PerChatLimiter:
+    """Не чаще одного сообщения в min_interval секунд в один и тот же чат."""
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._next: dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(chat_id, 0.0))
+            self._next[chat_id] = slot + self.min_interval
+            if len(self._next) > 100_000:
+                # старые записи больше не ограничивают — чистим, чтобы словарь не рос
+                self._next = {k: v for k, v in self._next.items() if v > now}
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+        return max(delay, 0.0)
+
+
+@dataclass
+class BroadcastReport:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    throttled_s: float = 0.0
+    elapsed_s: float = 0.0
+    failed_ids: list[int] = field(default_factory=list)
+
+    @property
+    def per_second(self) -> float:
+        return self.sent / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    def __str__(self) -> str:
+        out = (f"sent={self.sent}/{self.total} failed={self.failed} retries={self.retries} "
+               f"elapsed={self.elapsed_s:.2f}s rate={self.per_second:.1f}/s throttled={self.throttled_s:.2f}s")
+        if self.failed_ids:
+            # в лог — первые несколько чатов, чтобы было с чего начать разбор
+            shown = ",".join(map(str, self.failed_ids[:FAILED_IDS_SHOWN]))
+            more = f",…(+{len(self.failed_ids) - FAILED_IDS_SHOWN})" if len(self.failed_ids) > FAILED_IDS_SHOWN else ""
+            out += f" failed_ids={shown}{more}"
+        return out
+
+
+def _retry_after(e: Exception) -> float | None:
+    """retry_after из ApiTelegramException (429), иначе None."""
+    if getattr(e, "error_code", None) != 429:
+        return None
+    params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+
+class Broadcaster:
+    def __init__(self,
+                 send: Callable[[int, str], object],
+                 *,
+                 workers: int = 8,
+                 rate: float = DEFAULT_RATE,
+                 per_chat_interval: float = DEFAULT_PER_CHAT_S,
+                 progress_every: int = 1000):
+        self._send = send
+        self.workers = max(1, workers)
+        self.bucket = TokenBucket(rate)
+        self.per_chat = PerChatLimiter(per_chat_interval)
+        self.progress_every = progress_every
+
+    def _deliver(self, chat_id: int, text: str, report: BroadcastReport, lock: threading.Lock) -> None:
+        throttled = 0.0
+        for attempt in range(MAX_RETRIES + 1):
+            throttled += self.per_chat.acquire(chat_id)
+            throttled += self.bucket.acquire()
+            try:
+                self._send(chat_id, text)
+            except Exception as e:
+                wait = _retry_after(e)
+                if wait is not None and attempt < MAX_RETRIES:
+                    log.info("Telegram 429, pause %.1fs", wait)
+                    self.bucket.pause(wait)
+                    with lock:
+                        report.retries += 1
+                    continue
+                log.warning("Send failed to %s: %r", chat_id, e)
+                with lock:
+                    report.failed += 1
+                    report.failed_ids.append(chat_id)
+                    report.throttled_s += throttled
+                return
+            with lock:
+                report.sent += 1
+                report.throttled_s += throttled
+                done = report.sent + report.failed
+            if self.progress_every and done % self.progress_every == 0:
+                log.info("Broadcast progress: %d/%d", done, report.total)
+            return
+
+    def run(self, items: Iterable[tuple[int, str]]) -> BroadcastReport:
+        """Рассылает пары (chat_id, text) и ждёт завершения."""
+        items = list(items)
+        report = BroadcastReport(total=len(items))
+        lock = threading.Lock()
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="broadcast") as pool:
+            for chat_id, text in items:
+                pool.submit(self._deliver, chat_id, text, report, lock)
+        report.elapsed_s = time.perf_counter() - t0
+        return report
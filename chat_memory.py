@@ -0,0 +1,96 @@
+"""
+chat_memory.py — память диалога для /ask с ограничением по токенам.
+
+Промпт собирается так, чтобы начало было стабильным (удобно для кэша промптов у провайдера):
+  1) системный промпт — всегда один и тот же;
+  2) свёртка старых реплик (меняется только при свёртке);
+  3) окно последних реплик, сколько влезает в бюджет модели;
+  4) текущий вопрос.
+Старые реплики не копятся: сверх MAX_STORED_TURNS они сворачиваются в короткую
+выжимку из вопросов пользователя (без лишних вызовов LLM).
+"""
+
+from __future__ import annotations
+import os
+
+import db
+
+SYSTEM_PROMPT = (
+    "Ты отвечаешь кратко и по-существу.\n"
+    "Правила:\n"
+    "1) Технические ответы давай корректно и по пунктам.\n"
+)
+
+HISTORY_BUDGET = int(os.getenv("CHAT_HISTORY_TOKENS", "1200"))
+# маленьким моделям — окно поменьше
+MODEL_HISTORY_BUDGET = {
+    "meta-llama/llama-3.1-8b-instruct:free": 800,
+    "mistralai/mistral-small-24b-instruct-2501:free": 1000,
+}
+MAX_TURN_CHARS = 2000          # длиннее в историю не сохраняем
+MAX_STORED_TURNS = 40          # больше — сворачиваем самые старые
+KEEP_AFTER_FOLD = 20
+SUMMARY_MAX_CHARS = 800
+SUMMARY_ITEM_CHARS = 120
+
+
+def estimate_tokens(text: str) -> int:
+    # грубая оценка без токенизатора: ~3 символа на токен для смеси кириллицы и латиницы
+    return len(text) // 3 + 1
+
+
+def budget_for(model_key: str | None) -> int:
+    return MODEL_HISTORY_BUDGET.get(model_key or "", HISTORY_BUDGET)
+
+
+def build_messages(user_id: int, user_text: str, model_key: str | None = None) -> list[dict]:
+    budget = budget_for(model_key)
+    msgs = [{"role": "system", "content": SYSTEM_PROMPT}]
+
+    summary = db.get_chat_summary(user_id)
+    if summary and summary["tokens"] < budget:
+        msgs.append({"role": "system", "content": "Ранее в разговоре: " + summary["summary"]})
+        budget -= summary["tokens"]
+
+    window = []
+    for row in db.recent_chat_turns(user_id, MAX_STORED_TURNS):
+        if row["tokens"] > budget:
+            break
+        budget -= row["tokens"]
+        window.append({"role": row["role"], "content": row["content"]})
+    window.reverse()
+    while window and window[0]["role"] != "user":
+        window.pop(0)  # окно начинается с вопроса, а не с обрывка ответа
+
+    return msgs + window + [{"role": "user", "content": user_text}]
+
+
+def has_history(msgs: list[dict]) -> bool:
+    """
+    True, если в промпт попали свёртка или прошлые реплики. Такой промпт свой у каждого
+    пользователя: кэш ответов и склейка одинаковых запросов для него бесполезны.
+    """
+    return len(msgs) > 2
+
+
+def remember(user_id: int, question: str, answer: str) -> None:
+    q, a = question[:MAX_TURN_CHARS], answer[:MAX_TURN_CHARS]
+    db.add_chat_turns(user_id, [
+        ("user", q, estimate_tokens(q)),
+        ("assistant", a, estimate_tokens(a)),
+    ])
+    old = db.old_chat_turns(user_id, MAX_STORED_TURNS)
+    if old:
+        _fold(user_id, db.old_chat_turns(user_id, KEEP_AFTER_FOLD))
+
+
+def _fold(user_id: int, rows) -> None:
+    prev = db.get_chat_summary(user_id)
+    items = [prev["summary"]] if prev else []
+    items += ["• " + r["content"][:SUMMARY_ITEM_CHARS] for r in rows if r["role"] == "user"]
+    summary = "\n".join(items)[-SUMMARY_MAX_CHARS:]  # свежие темы важнее, старые обрезаем
+    db.fold_chat_turns(user_id, rows[-1]["id"], summary, estimate_tokens(summary))
+
+
+def forget(user_id: int) -> int:
+    return db.clear_chat(user_id)
@@ -18,6 +18,10 @@ LOG_LEVEL = getattr(logging, LOG_LEVEL_NAME, logging.INFO)
 
 DEFAULT_NOTIFY_HOUR = int(os.getenv("DEFAULT_NOTIFY_HOUR", "9"))
 
+# Режим получения апдейтов (polling/webhook) — в runmode.py: его импортируют и боты без config2
+from runmode import (BOT_MODE, BOT_THREADS, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+                     WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS, MODES)
+
 logging.basicConfig(
     level=LOG_LEVEL,
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
@@ -25,5 +29,9 @@ logging.basicConfig(
 
 if not TOKEN:
     raise RuntimeError("Нет TOKEN в .env — получите токен у @BotFather и положите его в .env")
+if BOT_MODE not in MODES:
+    raise RuntimeError("BOT_MODE должен быть polling или webhook")
 
-__all__ = ["TOKEN", "DB_PATH", "DEFAULT_NOTIFY_HOUR", "LOG_LEVEL"]
\ No newline at end of file
+__all__ = ["TOKEN", "DB_PATH", "DEFAULT_NOTIFY_HOUR", "LOG_LEVEL", "BOT_MODE", "BOT_THREADS",
+           "WEBHOOK_URL", "WEBHOOK_LISTEN", "WEBHOOK_PORT", "WEBHOOK_PATH", "WEBHOOK_SECRET",
+           "WEBHOOK_MAX_CONNECTIONS"]
\ No newline at end of file
@@ -1,16 +1,82 @@
+import atexit
 import os
-import sqlite3
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+import storage
 
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 
 
-def _connect():
-    conn = sqlite3.connect(DB_PATH, timeout=5.0)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
-    conn.execute("PRAGMA busy_timeout = 5000")
-    return conn
+def _read():
+    return storage.get_pool(DB_PATH).reader()
+
+
+def _write():
+    return storage.get_pool(DB_PATH).writer()
+
+
+def pool_stats() -> dict:
+    return storage.get_pool(DB_PATH).stats()
+
+
+# ---------- write-behind: групповая фиксация записей заметок ----------
+_write_queue: storage.WriteQueue | None = None
+
+
+def enable_write_behind(max_batch: int = 64, max_delay_ms: float = 5.0) -> None:
+    """Мутации заметок идут через один поток-писатель и фиксируются пачками."""
+    global _write_queue
+    if _write_queue is None:
+        _write_queue = storage.WriteQueue(storage.get_pool(DB_PATH), max_batch, max_delay_ms)
+
+
+def disable_write_behind() -> None:
+    global _write_queue
+    wq, _write_queue = _write_queue, None
+    if wq is not None:
+        wq.close()
+
+
+def write_queue_stats() -> dict | None:
+    return _write_queue.stats() if _write_queue is not None else None
+
+
+def _queue() -> storage.WriteQueue | None:
+    """
+    Очередь write-behind, если через неё можно писать из текущего потока. Поток, уже
+    держащий писателя (вложенный вызов в with _write() или операция самой очереди),
+    пишет напрямую: иначе он ждал бы поток-писатель, который ждёт его RLock.
+    """
+    wq = _write_queue
+    if wq is None or storage.get_pool(DB_PATH).owns_writer():
+        return None
+    return wq
+
+
+def _submit(op, *args) -> Future:
+    """Future с результатом op(conn, *args); без write-behind выполняется сразу."""
+    wq = _queue()
+    if wq is not None:
+        return wq.submit(op, *args)
+    fut = Future()
+    try:
+        fut.set_result(_run_write(op, *args))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+
+def _run_write(op, *args):
+    wq = _queue()
+    if wq is not None:
+        return wq.submit(op, *args).result()
+    with _write() as conn:
+        if not conn.in_transaction:   # вложенный вызов — продолжаем транзакцию внешнего with
+            conn.execute("BEGIN IMMEDIATE")
+        return op(conn, *args)
 
 
 def init_db():
@@ -25,6 +91,99 @@ def init_db():
     CREATE INDEX IF NOT EXISTS idx_user_id ON notes(user_id);
     CREATE INDEX IF NOT EXISTS idx_created_at ON notes(created_at);
 
+    -- полнотекстовый индекс по notes.text (external content: текст хранится только в notes).
+    -- user_id тоже проиндексирован: поиск ограничивает владельца прямо в MATCH,
+    -- иначе FTS перебирал бы совпадения всех пользователей и только потом фильтровал
+    CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+        text,
+        user_id,
+        content='notes',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+
+    -- unicode61 не считает «ё» диакритикой: индексируем текст с ё→е (длина и позиции слов
+    -- не меняются, поэтому snippet() по исходному notes.text подсвечивает правильно)
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts(rowid, text, user_id)
+        VALUES (new.id, replace(replace(new.text, 'ё', 'е'), 'Ё', 'Е'), new.user_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, text, user_id)
+        VALUES ('delete', old.id, replace(replace(old.text, 'ё', 'е'), 'Ё', 'Е'), old.user_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF text, user_id ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, text, user_id)
+        VALUES ('delete', old.id, replace(replace(old.text, 'ё', 'е'), 'Ё', 'Е'), old.user_id);
+        INSERT INTO notes_fts(rowid, text, user_id)
+        VALUES (new.id, replace(replace(new.text, 'ё', 'е'), 'Ё', 'Е'), new.user_id);
+    END;
+
+    -- счётчик заметок на пользователя: лимит проверяется за O(1), без чтения текстов
+    CREATE TABLE IF NOT EXISTS note_counts (
+        user_id INTEGER PRIMARY KEY,
+        n INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE TRIGGER IF NOT EXISTS notes_count_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO note_counts(user_id, n) VALUES (new.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET n = n + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS notes_count_ad AFTER DELETE ON notes BEGIN
+        UPDATE note_counts SET n = n - 1 WHERE user_id = old.user_id;
+    END;
+
+    -- заметки по дням (UTC, как created_at): /note_stats читает десятки строк, а не все заметки
+    CREATE TABLE IF NOT EXISTS note_daily (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS notes_daily_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO note_daily(user_id, day, n) VALUES (new.user_id, date(new.created_at), 1)
+        ON CONFLICT(user_id, day) DO UPDATE SET n = n + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS notes_daily_ad AFTER DELETE ON notes BEGIN
+        UPDATE note_daily SET n = n - 1 WHERE user_id = old.user_id AND day = date(old.created_at);
+        DELETE FROM note_daily WHERE user_id = old.user_id AND day = date(old.created_at) AND n <= 0;
+    END;
+
+    -- история диалога /ask: короткое окно последних реплик + свёртка старых
+    CREATE TABLE IF NOT EXISTS chat_turns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
+        content TEXT NOT NULL,
+        tokens INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_chat_turns_user ON chat_turns(user_id, id);
+
+    CREATE TABLE IF NOT EXISTS chat_summaries (
+        user_id INTEGER PRIMARY KEY,
+        summary TEXT NOT NULL,
+        tokens INTEGER NOT NULL
+    );
+
+    -- кэш ответов LLM: ключ — хэш (модель, сообщения, параметры)
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        last_hit INTEGER NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_llm_cache_last_hit ON llm_cache(last_hit);
+
     CREATE TABLE IF NOT EXISTS models (
         id INTEGER PRIMARY KEY,
         key TEXT NOT NULL UNIQUE,
@@ -34,6 +193,27 @@ def init_db():
 
     CREATE UNIQUE INDEX IF NOT EXISTS ux_models_single_active ON models(active) WHERE active=1;
 
+    -- версия реестра моделей: другие процессы по ней понимают, что их кэш устарел
+    CREATE TABLE IF NOT EXISTS models_meta (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL,
+        routing TEXT NOT NULL DEFAULT 'manual' CHECK (routing IN ('manual', 'auto'))
+    );
+
+    INSERT OR IGNORE INTO models_meta(id, version) VALUES (1, 1);
+
+    CREATE TRIGGER IF NOT EXISTS models_version_au AFTER UPDATE ON models BEGIN
+        UPDATE models_meta SET version = version + 1 WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS models_version_ai AFTER INSERT ON models BEGIN
+        UPDATE models_meta SET version = version + 1 WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS models_version_ad AFTER DELETE ON models BEGIN
+        UPDATE models_meta SET version = version + 1 WHERE id = 1;
+    END;
+
     INSERT OR IGNORE INTO models(id, key, label, active) VALUES
         (1, 'inception/mercury', 'Inception: Mercury', 1),
         (2, 'google/gemini-2.5-flash-lite-preview-06-17', 'google/gemini-2.5-flash-lite-preview-06-17', 0),
@@ -46,30 +226,130 @@ def init_db():
         (9, 'nvidia/llama-3.3-nemotron-super-49b-v1.5', 'NVIDIA: Llama 3.3 Nemotron Super 49B V1.5', 0),
         (10, 'qwen/qwen3-coder-30b-a3b-instruct', 'Qwen: Qwen3 Coder 30B A3B Instruct', 0);
     """
-    with _connect() as conn:
+    with _write() as conn:
+        existing = {r["name"] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if "notes_fts" in existing and \
+                "user_id" not in {r["name"] for r in conn.execute("PRAGMA table_info(notes_fts)")}:
+            # индекс старого формата (только text) — пересоздаём вместе с триггерами
+            conn.executescript("""
+                DROP TRIGGER IF EXISTS notes_fts_ai;
+                DROP TRIGGER IF EXISTS notes_fts_ad;
+                DROP TRIGGER IF EXISTS notes_fts_au;
+                DROP TABLE notes_fts;
+            """)
+            existing.discard("notes_fts")
+        elif "notes_fts" in existing and "'ё'" not in _trigger_sql(conn, "notes_fts_ai"):
+            # триггеры без свёртки ё→е — пересоздаём их, а индекс заполняем заново ниже
+            conn.executescript("""
+                DROP TRIGGER IF EXISTS notes_fts_ai;
+                DROP TRIGGER IF EXISTS notes_fts_ad;
+                DROP TRIGGER IF EXISTS notes_fts_au;
+            """)
+            existing.discard("notes_fts")
         conn.executescript(schema)
+        # миграция старых баз: режим выбора модели (manual — активная, auto — по задержке)
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(models_meta)")}
+        if "routing" not in cols:
+            conn.execute("ALTER TABLE models_meta ADD COLUMN routing TEXT NOT NULL DEFAULT 'manual'")
+        _load_models(conn)
+        if "note_counts" not in existing:
+            # старая база: пересчитываем счётчики один раз
+            conn.execute("DELETE FROM note_counts")
+            conn.execute("INSERT INTO note_counts(user_id, n) SELECT user_id, COUNT(*) FROM notes GROUP BY user_id")
+        if "note_daily" not in existing:
+            conn.execute("DELETE FROM note_daily")
+            conn.execute(
+                "INSERT INTO note_daily(user_id, day, n) "
+                "SELECT user_id, date(created_at), COUNT(*) FROM notes GROUP BY user_id, date(created_at)"
+            )
+    if "notes_fts" not in existing:
+        # старая база: заметки уже есть, а индекса ещё не было — заполняем один раз
+        rebuild_notes_index()
+
+
+def _trigger_sql(conn, name: str) -> str:
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (name,)).fetchone()
+    return row["sql"] if row else ""
+
+
+def rebuild_notes_index() -> None:
+    """Полностью перестраивает notes_fts по таблице notes (разовый backfill)."""
+    # не 'rebuild': он взял бы notes.text как есть, без свёртки ё→е из триггеров
+    with _write() as conn:
+        conn.execute("INSERT INTO notes_fts(notes_fts) VALUES ('delete-all')")
+        conn.execute(
+            "INSERT INTO notes_fts(rowid, text, user_id) "
+            "SELECT id, replace(replace(text, 'ё', 'е'), 'Ё', 'Е'), user_id FROM notes"
+        )
+
+
+# ---------- реестр моделей в памяти процесса ----------
+# 0 — не сверяться с БД (один процесс: все изменения идут через set_active_model);
+# N > 0 — не чаще раза в N секунд читать models_meta.version и перечитывать реестр при смене
+MODELS_VERSION_CHECK_S = float(os.getenv("MODELS_VERSION_CHECK_S", "0"))
+
+_models_lock = threading.Lock()
+_models: list[dict] | None = None
+_models_version = 0
+_models_checked_at = 0.0
+_routing = "manual"
+
+
+def _load_models(conn) -> None:
+    global _models, _models_version, _models_checked_at, _routing
+    rows = conn.execute("SELECT id,key,label,active FROM models ORDER BY id").fetchall()
+    meta = conn.execute("SELECT version, routing FROM models_meta WHERE id = 1").fetchone()
+    _models = [{"id": r["id"], "key": r["key"], "label": r["label"], "active": bool(r["active"])} for r in rows]
+    _models_version = meta["version"] if meta else 0
+    _routing = meta["routing"] if meta else "manual"
+    _models_checked_at = time.monotonic()
+
+
+def invalidate_models_cache() -> None:
+    global _models
+    with _models_lock:
+        _models = None
+
+
+def _cached_models() -> list[dict]:
+    global _models_checked_at
+    with _models_lock:
+        if _models is not None and MODELS_VERSION_CHECK_S > 0 \
+                and time.monotonic() - _models_checked_at >= MODELS_VERSION_CHECK_S:
+            with _read() as conn:
+                ver = conn.execute("SELECT version FROM models_meta WHERE id = 1").fetchone()
+                if ver and ver["version"] != _models_version:
+                    _load_models(conn)
+                else:
+                    _models_checked_at = time.monotonic()
+        if _models is None:
+            with _read() as conn:
+                _load_models(conn)
+        return _models
 
 
 def list_models() -> list[dict]:
-    with _connect() as conn:
-        rows = conn.execute("SELECT id,key,label,active FROM models ORDER BY id").fetchall()
-        return [{"id": r["id"], "key": r["key"], "label": r["label"], "active": bool(r["active"])} for r in rows]
+    return [dict(m) for m in _cached_models()]
 
 
 def get_active_model() -> dict:
-    with _connect() as conn:
+    for m in _cached_models():
+        if m["active"]:
+            return {"id": m["id"], "key": m["key"], "label": m["label"], "active": True}
+    # активной нет — назначаем первую (редкий путь, с записью)
+    with _models_lock, _write() as conn:
         row = conn.execute("SELECT id,key,label FROM models WHERE active=1").fetchone()
-        if row:
-            return {"id": row["id"], "key": row["key"], "label": row["label"], "active": True}
-        row = conn.execute("SELECT id,key,label FROM models ORDER BY id LIMIT 1").fetchone()
         if not row:
-            raise RuntimeError("В реестре моделей нет записей")
-        conn.execute("UPDATE models SET active=CASE WHEN id=? THEN 1 ELSE 0 END", (row["id"],))
+            row = conn.execute("SELECT id,key,label FROM models ORDER BY id LIMIT 1").fetchone()
+            if not row:
+                raise RuntimeError("В реестре моделей нет записей")
+            conn.execute("UPDATE models SET active=CASE WHEN id=? THEN 1 ELSE 0 END", (row["id"],))
+        _load_models(conn)
         return {"id": row["id"], "key": row["key"], "label": row["label"], "active": True}
 
 
 def set_active_model(model_id: int) -> dict:
-    with _connect() as conn:
+    with _models_lock, _write() as conn:
         conn.execute("BEGIN IMMEDIATE")
         exists = conn.execute("SELECT 1 FROM models WHERE id=?", (model_id,)).fetchone()
         if not exists:
@@ -80,21 +360,84 @@ def set_active_model(model_id: int) -> dict:
         # 2) затем включаем активность целевой модели
         conn.execute("UPDATE models SET active=1 WHERE id=?", (model_id,))
         conn.commit()
-        return get_active_model()
+        # write-through: кэш обновляется тем же подключением сразу после фиксации
+        _load_models(conn)
+    return get_active_model()
 
 
-def add_note(user_id: int, text: str) -> int:
-    with _connect() as conn:
-        cur = conn.execute(
-            "INSERT INTO notes(user_id, text) VALUES (?, ?)",
-            (user_id, text)
-        )
-        conn.commit()
+def get_routing_mode() -> str:
+    """'manual' — отвечает активная модель, 'auto' — самая быстрая здоровая (llm_autoroute)."""
+    _cached_models()
+    return _routing
+
+
+def set_routing_mode(mode: str) -> str:
+    if mode not in ("manual", "auto"):
+        raise ValueError("Неизвестный режим выбора модели")
+    with _models_lock, _write() as conn:
+        # версия растёт вручную: триггеры висят только на таблице models
+        conn.execute("UPDATE models_meta SET routing=?, version=version+1 WHERE id=1", (mode,))
+        _load_models(conn)
+    return mode
+
+
+def _op_add_note(conn, user_id: int, text: str) -> int:
+    cur = conn.execute(
+        "INSERT INTO notes(user_id, text) VALUES (?, ?)",
+        (user_id, text)
+    )
     return cur.lastrowid
 
 
+def _op_add_note_limited(conn, user_id: int, text: str, limit: int) -> tuple[int | None, int]:
+    count = _count_notes(conn, user_id)
+    if count >= limit:
+        return None, count
+    return _op_add_note(conn, user_id, text), count + 1
+
+
+def _op_update_note(conn, user_id: int, note_id: int, text: str) -> int:
+    cur = conn.execute(
+        """UPDATE notes
+        SET text = ?
+        WHERE user_id = ? AND id = ?""",
+        (text, user_id, note_id)
+    )
+    return cur.rowcount
+
+
+def _op_delete_note(conn, user_id: int, note_id: int) -> int:
+    cur = conn.execute(
+        "DELETE FROM notes WHERE user_id = ? AND id = ?",
+        (user_id, note_id)
+    )
+    return cur.rowcount
+
+
+def add_note(user_id: int, text: str) -> int:
+    return _run_write(_op_add_note, user_id, text)
+
+
+def add_note_limited(user_id: int, text: str, limit: int) -> tuple[int | None, int]:
+    """
+    Проверка лимита и вставка в одной транзакции.
+    Возвращает (id новой заметки, новое количество) или (None, текущее количество), если лимит исчерпан.
+    """
+    return _run_write(_op_add_note_limited, user_id, text, limit)
+
+
+def _count_notes(conn, user_id: int) -> int:
+    row = conn.execute("SELECT n FROM note_counts WHERE user_id = ?", (user_id,)).fetchone()
+    return row["n"] if row else 0
+
+
+def count_notes(user_id: int) -> int:
+    with _read() as conn:
+        return _count_notes(conn, user_id)
+
+
 def list_notes(user_id: int, limit: int = 50):
-    with _connect() as conn:
+    with _read() as conn:
         cur = conn.execute(
             """SELECT id, text, created_at
             FROM notes
@@ -103,48 +446,283 @@ def list_notes(user_id: int, limit: int = 50):
             LIMIT ?""",
             (user_id, limit)
         )
-    return cur.fetchall()
+        return cur.fetchall()
+
+
+def notes_page(user_id: int, *, before_id: int | None = None, after_id: int | None = None,
+               limit: int = 10) -> tuple[list, bool, bool]:
+    """
+    Страница заметок, новые сверху: (rows, есть_старше, есть_новее).
+    Keyset-пагинация по (user_id, id) без OFFSET: before_id — следующая страница (старше),
+    after_id — предыдущая (новее). Индекс idx_user_id уже содержит rowid (= id), поэтому
+    любая страница — это поиск по индексу плюс limit + 1 строк, как бы далеко ни листали.
+    """
+    with _read() as conn:
+        if after_id is not None:
+            rows = conn.execute(
+                "SELECT id, text, created_at FROM notes WHERE user_id = ? AND id > ? ORDER BY id ASC LIMIT ?",
+                (user_id, after_id, limit + 1)
+            ).fetchall()
+            has_newer = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_older = bool(rows) and conn.execute(
+                "SELECT EXISTS(SELECT 1 FROM notes WHERE user_id = ? AND id < ?)", (user_id, rows[-1]["id"])
+            ).fetchone()[0] == 1
+        else:
+            if before_id is None:
+                cur = conn.execute(
+                    "SELECT id, text, created_at FROM notes WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                    (user_id, limit + 1)
+                )
+            else:
+                cur = conn.execute(
+                    "SELECT id, text, created_at FROM notes WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (user_id, before_id, limit + 1)
+                )
+            rows = cur.fetchall()
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+            has_newer = bool(rows) and conn.execute(
+                "SELECT EXISTS(SELECT 1 FROM notes WHERE user_id = ? AND id > ?)", (user_id, rows[0]["id"])
+            ).fetchone()[0] == 1
+    return rows, has_older, has_newer
+
+
+def iter_notes(user_id: int, batch: int = 500):
+    """
+    Все заметки пользователя по порядку, пачками по batch строк с одного курсора:
+    память не растёт с числом заметок. Читающее подключение занято, пока идёт обход.
+    """
+    with _read() as conn:
+        cur = conn.execute(
+            "SELECT id, text, created_at FROM notes WHERE user_id = ? ORDER BY id",
+            (user_id,)
+        )
+        while rows := cur.fetchmany(batch):
+            yield from rows
+
+
+# период /note_stats -> число дней (None — за всё время)
+STATS_RANGES = {"week": 7, "month": 30, "all": None}
+
+
+def note_activity(user_id: int, days: int | None = 7) -> dict:
+    """
+    Активность по таблице note_daily за последние days дней (None — за всё время):
+      weekday — 7 счётчиков Пн..Вс;
+      buckets — [(день 'YYYY-MM-DD', n)], за всё время — по месяцам [('YYYY-MM', n)];
+      total — заметок за период; span_days — длина периода в днях.
+    Стоимость зависит от числа активных дней, а не от числа заметок.
+    """
+    where = "user_id = ?"
+    params: tuple = (user_id,)
+    if days is not None:
+        where += " AND day >= date('now', ?)"
+        params += (f"-{days - 1} days",)
+    bucket = "day" if days is not None else "substr(day, 1, 7)"
+    with _read() as conn:
+        weekday = [0] * 7
+        rows = conn.execute(
+            # %w: 0 = воскресенье; сдвигаем, чтобы 0 был понедельником
+            f"""SELECT (CAST(strftime('%w', day) AS INTEGER) + 6) % 7 AS wd, SUM(n) AS n
+            FROM note_daily WHERE {where} GROUP BY wd""",
+            params
+        )
+        for r in rows:
+            weekday[r["wd"]] = r["n"]
+        buckets = [(r["b"], r["n"]) for r in conn.execute(
+            f"SELECT {bucket} AS b, SUM(n) AS n FROM note_daily WHERE {where} GROUP BY b ORDER BY b",
+            params
+        )]
+        span = days
+        if span is None:
+            row = conn.execute(
+                "SELECT CAST(julianday('now') - julianday(MIN(day)) AS INTEGER) + 1 AS span "
+                "FROM note_daily WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            span = row["span"] or 1
+    return {"weekday": weekday, "buckets": buckets, "total": sum(weekday), "span_days": span}
+
+
+# маркеры подсветки в snippet(): управляющие символы не встречаются в обычном тексте,
+# поэтому обработчик может безопасно экранировать текст и потом заменить их на теги
+SNIPPET_OPEN = "\x02"
+SNIPPET_CLOSE = "\x03"
+
+
+def _fts_query(user_id: int, query: str) -> str:
+    # каждое слово — в кавычках (никакого синтаксиса FTS5 от пользователя) и с префиксным *;
+    # ищем только по началу слов: «ивет» не найдёт «Привет» (подстрочного поиска, как у LIKE, больше нет)
+    # ё→е, как в триггерах notes_fts: «ёлка» и «елка» находят друг друга
+    words = re.findall(r"\w+", query.replace("ё", "е").replace("Ё", "Е"))
+    if not words:
+        return ""
+    return f'user_id : "{user_id}" AND text : (' + " ".join(f'"{w}"*' for w in words) + ")"
 
 
 def find_notes(user_id: int, query: str, limit: int = 50):
-    with _connect() as conn:
+    match = _fts_query(user_id, query)
+    if not match:
+        return []
+    with _read() as conn:
         cur = conn.execute(
-            """SELECT id, text, created_at
-            FROM notes
-            WHERE user_id = ? AND text LIKE ?
-            ORDER BY id DESC
+            """SELECT n.id, n.text, n.created_at,
+                   snippet(notes_fts, 0, ?, ?, '…', 12) AS snippet
+            FROM notes_fts
+            JOIN notes n ON n.id = notes_fts.rowid
+            WHERE notes_fts MATCH ? AND n.user_id = ?
+            ORDER BY bm25(notes_fts, 1.0, 0.0), n.id DESC
             LIMIT ?""",
-            (user_id, f'%{query}%', limit)
+            (SNIPPET_OPEN, SNIPPET_CLOSE, match, user_id, limit)
         )
-    return cur.fetchall()
+        return cur.fetchall()
+
+
+def add_note_nowait(user_id: int, text: str) -> Future:
+    """Future с id новой заметки (в режиме write-behind не ждёт фиксации пачки)."""
+    return _submit(_op_add_note, user_id, text)
+
+
+def update_note_nowait(user_id: int, note_id: int, text: str) -> Future:
+    """Future с rowcount обновления."""
+    return _submit(_op_update_note, user_id, note_id, text)
+
+
+def delete_note_nowait(user_id: int, note_id: int) -> Future:
+    """Future с rowcount удаления."""
+    return _submit(_op_delete_note, user_id, note_id)
 
 
 def update_note(user_id: int, note_id: int, text: str) -> bool:
-    with _connect() as conn:
+    return _run_write(_op_update_note, user_id, note_id, text) > 0
+
+
+def delete_note(user_id: int, note_id: int) -> bool:
+    return _run_write(_op_delete_note, user_id, note_id) > 0
+
+
+def add_chat_turns(user_id: int, turns: list[tuple[str, str, int]]) -> None:
+    """turns — [(role, content, tokens), ...] одной транзакцией."""
+    with _write() as conn:
+        conn.executemany(
+            "INSERT INTO chat_turns(user_id, role, content, tokens) VALUES (?, ?, ?, ?)",
+            [(user_id, role, content, tokens) for role, content, tokens in turns]
+        )
+
+
+def recent_chat_turns(user_id: int, limit: int):
+    """Последние реплики пользователя, от новых к старым."""
+    with _read() as conn:
         cur = conn.execute(
-            """UPDATE notes
-            SET text = ?
-            WHERE user_id = ? AND id = ?""",
-            (text, user_id, note_id)
+            """SELECT id, role, content, tokens
+            FROM chat_turns
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT ?""",
+            (user_id, limit)
         )
-        conn.commit()
-    return cur.rowcount > 0
+        return cur.fetchall()
 
 
-def delete_note(user_id: int, note_id: int) -> bool:
-    with _connect() as conn:
+def old_chat_turns(user_id: int, keep: int):
+    """Реплики старше последних keep, от старых к новым (кандидаты на свёртку)."""
+    with _read() as conn:
         cur = conn.execute(
-            "DELETE FROM notes WHERE user_id = ? AND id = ?",
-            (user_id, note_id)
+            """SELECT id, role, content FROM (
+                SELECT id, role, content
+                FROM chat_turns
+                WHERE user_id = ?
+                ORDER BY id DESC
+                LIMIT -1 OFFSET ?
+            ) ORDER BY id""",
+            (user_id, keep)
         )
-        conn.commit()
-    return cur.rowcount > 0
+        return cur.fetchall()
+
+
+def get_chat_summary(user_id: int):
+    with _read() as conn:
+        return conn.execute(
+            "SELECT summary, tokens FROM chat_summaries WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+
+def fold_chat_turns(user_id: int, upto_id: int, summary: str, tokens: int) -> None:
+    """Заменяет реплики с id <= upto_id свёрткой summary — атомарно."""
+    with _write() as conn:
+        conn.execute("DELETE FROM chat_turns WHERE user_id = ? AND id <= ?", (user_id, upto_id))
+        conn.execute(
+            """INSERT INTO chat_summaries(user_id, summary, tokens) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, tokens = excluded.tokens""",
+            (user_id, summary, tokens)
+        )
+
+
+def clear_chat(user_id: int) -> int:
+    with _write() as conn:
+        n = conn.execute("DELETE FROM chat_turns WHERE user_id = ?", (user_id,)).rowcount
+        conn.execute("DELETE FROM chat_summaries WHERE user_id = ?", (user_id,))
+    return n
+
+
+def cache_get(key: str, min_created_at: int) -> tuple[str, int, str] | None:
+    """(ответ, created_at, модель, которая его дала) для живой записи кэша или None."""
+    with _read() as conn:
+        row = conn.execute(
+            "SELECT response, created_at, model FROM llm_cache WHERE key = ? AND created_at >= ?",
+            (key, min_created_at)
+        ).fetchone()
+    if row is None:
+        return None
+    return row["response"], row["created_at"], row["model"]
+
+
+def cache_touch(hits: list[tuple[int, int, str]]) -> None:
+    """Пачка попаданий (сколько, время последнего, ключ) — одна транзакция вместо записи на каждое."""
+    with _write() as conn:
+        conn.executemany("UPDATE llm_cache SET hits = hits + ?, last_hit = MAX(last_hit, ?) WHERE key = ?", hits)
+
+
+def cache_put(key: str, model: str, response: str) -> None:
+    with _write() as conn:
+        conn.execute(
+            """INSERT INTO llm_cache(key, model, response, created_at, last_hit)
+            VALUES (?, ?, ?, CAST(strftime('%s','now') AS INTEGER), CAST(strftime('%s','now') AS INTEGER))
+            ON CONFLICT(key) DO UPDATE SET
+                model = excluded.model,
+                response = excluded.response,
+                created_at = excluded.created_at,
+                last_hit = excluded.last_hit""",
+            (key, model, response)
+        )
+
+
+def cache_evict(min_created_at: int, max_rows: int) -> int:
+    """Удаляет просроченные записи и самые давно не использованные сверх max_rows."""
+    with _write() as conn:
+        n = conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (min_created_at,)).rowcount
+        n += conn.execute(
+            """DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?
+            )""",
+            (max_rows,)
+        ).rowcount
+    return n
 
 
 def get_note(user_id: int, note_id: int):
-    with _connect() as conn:
+    with _read() as conn:
         cur = conn.execute(
             "SELECT id, text, created_at FROM notes WHERE user_id = ? AND id = ?",
             (user_id, note_id)
         )
-    return cur.fetchone()
\ No newline at end of file
+        return cur.fetchone()
+
+
+atexit.register(disable_write_behind)
+if os.getenv("NOTES_WRITE_BEHIND") == "1":
+    enable_write_behind(
+        max_batch=int(os.getenv("NOTES_WRITE_BATCH", "64")),
+        max_delay_ms=float(os.getenv("NOTES_WRITE_DELAY_MS", "5")),
+    )
@@ -7,31 +7,38 @@ db.py — слой данных для DailyZodiakBot.
   - notify_hour INTEGER      — час суток (0..23), когда слать сообщение
   - subscribed INTEGER       — 1/0 — подписка включена/выключена
   - last_sent_date TEXT      — 'YYYY-MM-DD', чтобы не слать повторно за день
+  - claimed_by TEXT          — id воркера, который сейчас рассылает этому пользователю
+  - claim_until INTEGER      — unix-время окончания аренды (упавший воркер её не продлит)
 
 Приёмы:
-  - отдельное подключение под каждую операцию (with _connect());
+  - общий пул подключений из storage.py: чтение через _read(), запись через _write();
   - PRAGMA: WAL + busy_timeout + row_factory=Row (см. Л3) [oai_citation:5‡L3.pdf](file-service://file-TzQZFVK22mksuAGPBby5ME);
   - все SQL — параметризованные через "?" (никаких f-строк).
 """
 
 from __future__ import annotations
+import json
 import sqlite3
 import logging
-from typing import Optional
+import time
+from typing import Callable, Iterable, Optional
 
+import storage
 from config2 import DB_PATH, DEFAULT_NOTIFY_HOUR
 
 log = logging.getLogger(__name__)
 
 
 # ---------- подключение с «правильными» PRAGMA (см. Л3) ----------
-def _connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, timeout=5.0)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
-    conn.execute("PRAGMA busy_timeout = 5000")
-    return conn
+# PRAGMA применяются один раз при создании подключения в пуле (storage._open).
+def _read():
+    return storage.get_pool(DB_PATH).reader()
+
+def _write():
+    return storage.get_pool(DB_PATH).writer()
+
+def pool_stats() -> dict:
+    return storage.get_pool(DB_PATH).stats()
 # WAL + busy_timeout уменьшают «database is locked», row_factory даёт доступ к полям по имени [oai_citation:6‡L3.pdf](file-service://file-TzQZFVK22mksuAGPBby5ME)
 
 
@@ -52,41 +59,67 @@ def init_db() -> None:
 
     CREATE INDEX IF NOT EXISTS idx_users_hour ON users(notify_hour);
     CREATE INDEX IF NOT EXISTS idx_users_sent ON users(last_sent_date);
+    CREATE INDEX IF NOT EXISTS idx_users_active_hour ON users(notify_hour)
+        WHERE subscribed = 1 AND sign IS NOT NULL;
     """
-    with _connect() as conn:
+    with _write() as conn:
         conn.executescript(schema)
+        # миграция старых баз: колонки аренды для рассылки несколькими воркерами
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+        if "claimed_by" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN claimed_by TEXT")
+        if "claim_until" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN claim_until INTEGER")
     log.info("DB initialized: %s", DB_PATH)
 
 
 # ---------- upsert/получение пользователя ----------
 def ensure_user(user_id: int) -> None:
     """Гарантируем наличие строки пользователя с дефолтами."""
-    with _connect() as conn:
+    with _write() as conn:
         conn.execute(
             "INSERT OR IGNORE INTO users(user_id, notify_hour, subscribed) VALUES (?, ?, 1)",
             (user_id, DEFAULT_NOTIFY_HOUR)
         )
 
 def get_user(user_id: int) -> Optional[sqlite3.Row]:
-    with _connect() as conn:
+    with _read() as conn:
         cur = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         return cur.fetchone()
 
 
+# ---------- подписчики на изменения расписания (планировщик рассылки) ----------
+_schedule_listeners: list[Callable[[], None]] = []
+
+def add_schedule_listener(cb: Callable[[], None]) -> None:
+    """cb() вызывается после изменений, влияющих на расписание рассылки."""
+    _schedule_listeners.append(cb)
+
+def _schedule_changed() -> None:
+    for cb in list(_schedule_listeners):
+        try:
+            cb()
+        except Exception as e:
+            log.warning("Schedule listener failed: %r", e)
+
+
 # ---------- настройки профиля ----------
 def set_sign(user_id: int, sign: str) -> None:
-    with _connect() as conn:
+    with _write() as conn:
         conn.execute("UPDATE users SET sign = ? WHERE user_id = ?", (sign, user_id))
+    _schedule_changed()
 
 def set_notify_hour(user_id: int, hour: int) -> None:
     hour = max(0, min(int(hour), 23))
-    with _connect() as conn:
+    with _write() as conn:
         conn.execute("UPDATE users SET notify_hour = ? WHERE user_id = ?", (hour, user_id))
+    _schedule_changed()
 
 def set_subscribed(user_id: int, on: bool) -> None:
     val = 1 if on else 0
-    with _connect() as conn:
+    with _write() as conn:
         conn.execute("UPDATE users SET subscribed = ? WHERE user_id = ?", (val, user_id))
+    _schedule_changed()
 
 
 # ---------- рассылка: выборка и отметка отправки ----------
@@ -94,7 +127,7 @@ def list_due_users(today_str: str, hour: int) -> list[sqlite3.Row]:
     """
     Вернёт пользователей, кому надо отправить: подписан, час совпал, ещё не отправляли сегодня, знак задан.
     """
-    with _connect() as conn:
+    with _read() as conn:
         cur = conn.execute(
             """
             SELECT user_id, sign
@@ -108,6 +141,73 @@ def list_due_users(today_str: str, hour: int) -> list[sqlite3.Row]:
         )
         return cur.fetchall()
 
+def list_notify_hours() -> list[int]:
+    """Часы, в которые есть кому слать (по частичному индексу idx_users_active_hour)."""
+    with _read() as conn:
+        cur = conn.execute(
+            """
+            SELECT DISTINCT notify_hour
+            FROM users
+            WHERE subscribed = 1 AND sign IS NOT NULL
+            ORDER BY notify_hour
+            """
+        )
+        return [r["notify_hour"] for r in cur.fetchall()]
+
 def mark_sent_today(user_id: int, today_str: str) -> None:
-    with _connect() as conn:
-        conn.execute("UPDATE users SET last_sent_date = ? WHERE user_id = ?", (today_str, user_id))
\ No newline at end of file
+    with _write() as conn:
+        conn.execute("UPDATE users SET last_sent_date = ? WHERE user_id = ?", (today_str, user_id))
+
+
+# ---------- рассылка несколькими воркерами: аренда пачки и массовое подтверждение ----------
+def claim_due_users(today_str: str, hour: int, worker_id: str,
+                    limit: int = 500, lease_s: int = 300) -> list[sqlite3.Row]:
+    """
+    Одним UPDATE ... RETURNING забирает в аренду до limit пользователей, кому пора слать.
+    Чужие живые аренды пропускаются; просроченные (воркер упал) забираются заново.
+    """
+    now = int(time.time())
+    with _write() as conn:
+        cur = conn.execute(
+            """
+            UPDATE users
+            SET claimed_by = ?, claim_until = ?
+            WHERE user_id IN (
+                SELECT user_id
+                FROM users
+                WHERE subscribed = 1
+                  AND sign IS NOT NULL
+                  AND notify_hour = ?
+                  AND (last_sent_date IS NULL OR last_sent_date <> ?)
+                  AND (claim_until IS NULL OR claim_until < ?)
+                LIMIT ?
+            )
+            RETURNING user_id, sign
+            """,
+            (worker_id, now + lease_s, hour, today_str, now, limit)
+        )
+        return cur.fetchall()
+
+def mark_sent_bulk(user_ids: Iterable[int], today_str: str, worker_id: str) -> int:
+    """Отмечает отправку и снимает аренду разом; чужие (перехваченные) аренды не трогает."""
+    ids = json.dumps([int(u) for u in user_ids])
+    with _write() as conn:
+        cur = conn.execute(
+            """
+            UPDATE users
+            SET last_sent_date = ?, claimed_by = NULL, claim_until = NULL
+            WHERE claimed_by = ?
+              AND user_id IN (SELECT value FROM json_each(?))
+            """,
+            (today_str, worker_id, ids)
+        )
+        return cur.rowcount
+
+def release_claims(worker_id: str) -> int:
+    """Отпускает все аренды воркера (например, при остановке), чтобы другие подхватили сразу."""
+    with _write() as conn:
+        cur = conn.execute(
+            "UPDATE users SET claimed_by = NULL, claim_until = NULL WHERE claimed_by = ?",
+            (worker_id,)
+        )
+        return cur.rowcount
@@ -0,0 +1,194 @@
+"""
+llm_autoroute.py — автоматический выбор модели по задержке (режим /model auto).
+
+  - по каждой модели держим EWMA задержки и EWMA доли ошибок. Задержку берём по
+    первому байту/токену: она меньше зависит от длины ответа, чем полное время;
+  - данные приходят из реальных вызовов (через llm_metrics) и, если включено,
+    из лёгких фоновых проб (max_tokens=1);
+  - запрос получает самая быстрая здоровая модель из разрешённого набора;
+  - гистерезис: текущую модель меняем, только если другая быстрее на HYSTERESIS
+    и выбор продержался MIN_HOLD_S, — иначе маршрут «прыгал» бы от шума.
+    Нездоровую модель (много ошибок или открыт breaker) меняем сразу;
+  - разведка: доля EXPLORE_RATE запросов уходит не текущей, а другой здоровой модели —
+    сначала без данных, потом с самыми старыми. Иначе без фоновых проб модели, которые
+    ни разу не выбирались, так и остались бы без оценки, а ускорившаяся — незамеченной.
+"""
+
+from __future__ import annotations
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List
+
+import llm_metrics
+from llm_router import breaker
+from openrouter_client import OpenRouterError, chat_once, last_timing
+
+log = logging.getLogger(__name__)
+
+# разрешённый набор через запятую; пусто — все модели реестра
+AUTO_MODELS = [k.strip() for k in os.getenv("LLM_AUTO_MODELS", "").split(",") if k.strip()]
+EWMA_ALPHA = float(os.getenv("LLM_AUTO_ALPHA", "0.3"))
+MAX_ERROR_RATE = float(os.getenv("LLM_AUTO_MAX_ERRORS", "0.5"))
+HYSTERESIS = float(os.getenv("LLM_AUTO_HYSTERESIS", "0.2"))
+MIN_HOLD_S = float(os.getenv("LLM_AUTO_MIN_HOLD", "30"))
+PROBE_INTERVAL_S = float(os.getenv("LLM_AUTO_PROBE_INTERVAL", "0"))   # 0 — без фоновых проб
+EXPLORE_RATE = float(os.getenv("LLM_AUTO_EXPLORE", "0.05"))            # 0 — без разведки
+
+
+@dataclass
+class ModelHealth:
+    latency_ms: float | None = None
+    error_rate: float = 0.0
+    samples: int = 0
+    updated_at: float = 0.0
+
+    def observe(self, ok: bool, latency_ms: float | None, alpha: float) -> None:
+        self.error_rate = alpha * (0.0 if ok else 1.0) + (1 - alpha) * self.error_rate
+        if ok and latency_ms is not None:
+            self.latency_ms = latency_ms if self.latency_ms is None \
+                else alpha * latency_ms + (1 - alpha) * self.latency_ms
+        self.samples += 1
+        self.updated_at = time.monotonic()
+
+
+class AutoRouter:
+    def __init__(self, *, alpha: float = EWMA_ALPHA, max_error_rate: float = MAX_ERROR_RATE,
+                 hysteresis: float = HYSTERESIS, min_hold_s: float = MIN_HOLD_S,
+                 explore_rate: float = EXPLORE_RATE, rng: random.Random | None = None,
+                 now: Callable[[], float] = time.monotonic):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.hysteresis = hysteresis
+        self.min_hold_s = min_hold_s
+        self.explore_rate = explore_rate
+        self._rng = rng or random.Random()
+        self._now = now
+        self._health: Dict[str, ModelHealth] = {}
+        self._lock = threading.Lock()
+        self.current: str | None = None
+        self._chosen_at = 0.0
+        self.switches = 0
+        self.explored = 0
+
+    # ---------- наблюдения ----------
+    def observe(self, model: str, ok: bool, latency_ms: float | None) -> None:
+        with self._lock:
+            self._health.setdefault(model, ModelHealth()).observe(ok, latency_ms, self.alpha)
+
+    def on_call(self, rec: llm_metrics.CallRecord) -> None:
+        """Слушатель llm_metrics: кэш и склейка не говорят о скорости модели — пропускаем."""
+        if rec.cached or rec.coalesced:
+            return
+        ok = rec.status // 100 == 2
+        self.observe(rec.model, ok, rec.ttfb_ms if rec.ttfb_ms is not None else rec.latency_ms)
+
+    # ---------- выбор ----------
+    def _healthy(self, model: str) -> bool:
+        h = self._health.get(model)
+        if h is not None and h.error_rate > self.max_error_rate:
+            return False
+        return breaker(model).state != "open"
+
+    def _score(self, model: str) -> float | None:
+        h = self._health.get(model)
+        if h is None or h.latency_ms is None:
+            return None
+        # ошибки штрафуем: модель, которая часто падает, фактически медленнее
+        return h.latency_ms * (1 + h.error_rate)
+
+    def _updated_at(self, model: str) -> float:
+        h = self._health.get(model)
+        return h.updated_at if h is not None else 0.0
+
+    def rank(self, models: Iterable[str]) -> List[str]:
+        """Здоровые по возрастанию оценки, затем без данных, затем нездоровые."""
+        with self._lock:
+            def key(m: str):
+                s = self._score(m)
+                return (not self._healthy(m), s is None, s or 0.0)
+            return sorted(models, key=key)
+
+    def choose(self, candidates: List[str], default: str) -> str:
+        if not candidates:
+            return default
+        with self._lock:
+            now = self._now()
+            healthy = [m for m in candidates if self._healthy(m)]
+            scored = {m: s for m in healthy if (s := self._score(m)) is not None}
+            others = [m for m in healthy if m != self.current]
+            if self.current is not None and others and self._rng.random() < self.explore_rate:
+                # разовый запрос другой модели; текущий выбор и его «удержание» не трогаем
+                self.explored += 1
+                return min(others, key=lambda m: (m in scored, self._updated_at(m)))
+            cur = self.current if self.current in healthy else None
+            if scored:
+                best = min(scored, key=scored.get)
+            elif cur is not None:
+                best = cur
+            else:
+                # данных ещё нет — начинаем с ручной активной модели или первой здоровой
+                best = default if default in healthy else (healthy or candidates)[0]
+            if cur is not None and best != cur:
+                cur_score = scored.get(cur)
+                held = now - self._chosen_at < self.min_hold_s
+                better = cur_score is None or scored[best] < cur_score * (1 - self.hysteresis)
+                if held or not better:
+                    return cur
+            if best != self.current:
+                log.info("Auto routing: %s -> %s", self.current, best)
+                self.current = best
+                self._chosen_at = now
+                self.switches += 1
+            return best
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                m: {"latency_ms": None if h.latency_ms is None else int(h.latency_ms),
+                    "error_rate": round(h.error_rate, 3), "samples": h.samples,
+                    "healthy": self._healthy(m)}
+                for m, h in sorted(self._health.items())
+            }
+
+    # ---------- фоновые пробы ----------
+    def probe(self, model: str) -> None:
+        try:
+            chat_once([{"role": "user", "content": "ping"}], model=model, temperature=0, max_tokens=1,
+                      timeout_s=15)
+        except OpenRouterError as e:
+            log.info("Probe %s failed [%s]", model, e.status)
+            self.observe(model, False, None)
+            return
+        t = last_timing()
+        self.observe(model, True, t.get("ttfb_ms", t.get("total_ms")))
+
+    def start_probes(self, models: Callable[[], List[str]], interval_s: float = PROBE_INTERVAL_S) -> None:
+        """Раз в interval_s пробует каждую модель из models(). В метрики /llm_stats пробы не попадают."""
+        if interval_s <= 0:
+            return
+
+        def loop() -> None:
+            while True:
+                for m in models():
+                    try:
+                        self.probe(m)
+                    except Exception as e:
+                        log.warning("Probe %s error: %r", m, e)
+                time.sleep(interval_s)
+
+        threading.Thread(target=loop, name="llm-probes", daemon=True).start()
+
+
+def allowed(registry_keys: List[str]) -> List[str]:
+    """Разрешённый набор для авто-выбора в порядке реестра."""
+    if not AUTO_MODELS:
+        return list(registry_keys)
+    return [k for k in registry_keys if k in AUTO_MODELS]
+
+
+router = AutoRouter()
+llm_metrics.add_listener(router.on_call)
@@ -0,0 +1,205 @@
+"""
+llm_cache.py — кэш ответов /ask: LRU в памяти поверх таблицы llm_cache в SQLite,
+плюс SingleFlight — склейка одинаковых запросов, которые выполняются прямо сейчас.
+
+Ключ — sha256 от (модель, нормализованные сообщения, temperature, max_tokens).
+Кэшируем только при низкой температуре, где повтор одного и того же ответа допустим.
+В main2.py кэш и склейка работают только для вопросов без истории диалога: с историей
+промпт уникален для пользователя (chat_memory.has_history) и обходит их.
+TTL и ограничение по числу строк — LLM_CACHE_TTL / LLM_CACHE_MAX_ROWS.
+"""
+
+from __future__ import annotations
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import db
+
+log = logging.getLogger(__name__)
+
+MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3"))
+TTL_S = int(os.getenv("LLM_CACHE_TTL", str(24 * 3600)))
+MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", "5000"))
+MEMORY_SIZE = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "256"))
+EVICT_EVERY = 100  # чистим таблицу раз в N записей, а не на каждой
+HITS_FLUSH_EVERY = 50  # попадания (hits/last_hit для вытеснения) пишем пачкой, а не на каждом
+
+
+def _normalize(messages: list[dict]) -> list[list[str]]:
+    # регистр и лишние пробелы не меняют смысла вопроса, но ломали бы совпадение ключа
+    return [[m["role"], " ".join(str(m["content"]).split()).casefold()] for m in messages]
+
+
+def make_key(model: str, messages: list[dict], temperature: float, max_tokens: int) -> str:
+    raw = json.dumps([model, _normalize(messages), round(float(temperature), 3), int(max_tokens)],
+                     ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cacheable(temperature: float) -> bool:
+    return temperature <= MAX_TEMPERATURE
+
+
+class ResponseCache:
+    def __init__(self, memory_size: int = MEMORY_SIZE, ttl_s: int = TTL_S, max_rows: int = MAX_ROWS):
+        self.memory_size = memory_size
+        self.ttl_s = ttl_s
+        self.max_rows = max_rows
+        self._mem: OrderedDict[str, tuple[float, str, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._pending_hits: dict[str, tuple[int, int]] = {}   # ключ -> (попаданий, время последнего)
+        self.counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "puts": 0, "evicted": 0}
+
+    def _remember(self, key: str, created: float, text: str, answered_by: str) -> None:
+        self._mem[key] = (created, text, answered_by)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_size:
+            self._mem.popitem(last=False)
+
+    def get(self, model: str, messages: list[dict], temperature: float,
+            max_tokens: int) -> tuple[str, str] | None:
+        """(ответ, модель, которая его дала) — при fallback это не обязательно model."""
+        if not cacheable(temperature):
+            return None
+        key = make_key(model, messages, temperature, max_tokens)
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None and now - item[0] <= self.ttl_s:
+                self._mem.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                flush = self._note_hit(key, now)
+            else:
+                self._mem.pop(key, None)
+                item = None
+        if item is not None:
+            if flush:
+                self.flush_hits()
+            return item[1], item[2]
+        try:
+            row = db.cache_get(key, int(now - self.ttl_s))
+        except Exception as e:
+            # кэш — не источник истины: при сбое БД просто идём к модели
+            log.warning("LLM cache read failed: %r", e)
+            row = None
+        with self._lock:
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            text, created, answered_by = row
+            self.counters["db_hits"] += 1
+            self._remember(key, created, text, answered_by)
+            flush = self._note_hit(key, now)
+        if flush:
+            self.flush_hits()
+        return text, answered_by
+
+    def _note_hit(self, key: str, now: float) -> bool:
+        """Копит попадание в памяти (под self._lock); True — пора сбросить пачку в БД."""
+        n, _ = self._pending_hits.get(key, (0, 0))
+        self._pending_hits[key] = (n + 1, int(now))
+        return len(self._pending_hits) >= HITS_FLUSH_EVERY
+
+    def flush_hits(self) -> None:
+        """Одна запись в БД на пачку попаданий. Best-effort: при сбое счётчики теряются, ответ — нет."""
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+        if not pending:
+            return
+        try:
+            db.cache_touch([(n, ts, key) for key, (n, ts) in pending.items()])
+        except Exception as e:
+            log.warning("LLM cache hit bookkeeping dropped (%d keys): %r", len(pending), e)
+
+    def put(self, model: str, messages: list[dict], temperature: float, max_tokens: int, text: str,
+            answered_by: str | None = None) -> None:
+        """model — ключ запроса; answered_by — модель, которая фактически ответила (fallback)."""
+        if not cacheable(temperature) or not text:
+            return
+        key = make_key(model, messages, temperature, max_tokens)
+        answered_by = answered_by or model
+        try:
+            db.cache_put(key, answered_by, text)
+        except Exception as e:
+            # ответ пользователю важнее кэша: сбой записи только логируем
+            log.warning("LLM cache write failed: %r", e)
+            return
+        with self._lock:
+            self._remember(key, time.time(), text, answered_by)
+            self.counters["puts"] += 1
+            self._puts += 1
+            evict = self._puts % EVICT_EVERY == 0
+        if evict:
+            # вытеснение идёт по last_hit — сначала сбрасываем накопленные попадания
+            self.flush_hits()
+            try:
+                n = db.cache_evict(int(time.time() - self.ttl_s), self.max_rows)
+            except Exception as e:
+                log.warning("LLM cache eviction failed: %r", e)
+                return
+            with self._lock:
+                self.counters["evicted"] += n
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self.counters)
+            out["memory_entries"] = len(self._mem)
+        total = out["memory_hits"] + out["db_hits"] + out["misses"]
+        out["hit_rate"] = round((out["memory_hits"] + out["db_hits"]) / total, 3) if total else 0.0
+        return out
+
+
+response_cache = ResponseCache()
+atexit.register(response_cache.flush_hits)   # раньше atexit из db.py (LIFO): пул ещё открыт
+
+
+class SingleFlight:
+    """
+    Одновременные запросы с одинаковым ключом ждут один вызов upstream:
+    первый («ведущий») выполняет его, остальные получают тот же результат или ту же ошибку.
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.counters = {"upstream_calls": 0, "coalesced": 0}
+
+    def begin(self, key: str) -> tuple[Future, bool]:
+        """(future, True) — вызывающий ведущий и обязан вызвать end(); (future, False) — ждать future."""
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.counters["coalesced"] += 1
+                return fut, False
+            fut = Future()
+            fut.set_running_or_notify_cancel()
+            self._inflight[key] = fut
+            self.counters["upstream_calls"] += 1
+            return fut, True
+
+    def end(self, key: str, result=None, error: BaseException | None = None) -> None:
+        with self._lock:
+            fut = self._inflight.pop(key, None)
+        if fut is None:
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self.counters)
+            out["in_flight"] = len(self._inflight)
+        return out
+
+
+inflight = SingleFlight()
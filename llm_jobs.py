@@ -0,0 +1,147 @@
+"""
+llm_jobs.py — отдельная очередь для долгих LLM-запросов (/ask).
+
+Обработчики telebot только ставят задачу и сразу освобождаются, поэтому команды
+заметок не ждут медленные модели. Внутри:
+  - ограниченный пул воркеров;
+  - честность: пользователи обслуживаются по кругу (round-robin), у каждого
+    не больше per_user_running задач в работе и per_user_pending в очереди;
+  - переполнение — QueueFullError, а не бесконечный хвост;
+  - cancel(user_id) снимает ещё не начатые задачи пользователя.
+"""
+
+from __future__ import annotations
+import itertools
+import logging
+import threading
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+log = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: int
+    user_id: int
+    fn: Callable[[], object]
+    cancelled: bool = field(default=False)
+
+
+class FairJobQueue:
+    def __init__(self, workers: int = 4, per_user_running: int = 1,
+                 per_user_pending: int = 3, max_pending: int = 200):
+        self.workers = max(1, workers)
+        self.per_user_running = max(1, per_user_running)
+        self.per_user_pending = max(1, per_user_pending)
+        self.max_pending = max_pending
+        self._pending: dict[int, deque[Job]] = {}
+        self._ring: deque[int] = deque()        # пользователи с задачами в очереди, по кругу
+        self._running: Counter[int] = Counter()
+        self._busy = 0
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.counters = {"submitted": 0, "done": 0, "failed": 0, "rejected": 0, "cancelled": 0}
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"llm-job-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _pending_total(self) -> int:
+        return sum(len(q) for q in self._pending.values())
+
+    # ---------- API ----------
+    def submit(self, user_id: int, fn: Callable[[], object]) -> int:
+        """
+        Ставит задачу. Вернёт примерную позицию в очереди: 0 — начнётся сразу.
+        QueueFullError — очередь (общая или пользователя) переполнена.
+        """
+        with self._cond:
+            total = self._pending_total()
+            user_q = self._pending.get(user_id)
+            if total >= self.max_pending or (user_q and len(user_q) >= self.per_user_pending):
+                self.counters["rejected"] += 1
+                raise QueueFullError()
+            job = Job(next(self._ids), user_id, fn)
+            if user_q is None:
+                user_q = self._pending[user_id] = deque()
+                self._ring.append(user_id)
+            user_q.append(job)
+            self.counters["submitted"] += 1
+            starts_now = (self._busy < self.workers and total == 0
+                          and self._running[user_id] < self.per_user_running)
+            self._cond.notify()
+            return 0 if starts_now else total + 1
+
+    def cancel(self, user_id: int) -> int:
+        """Снимает все ещё не начатые задачи пользователя; вернёт их число."""
+        with self._cond:
+            jobs = self._pending.pop(user_id, None) or deque()
+            if user_id in self._ring:
+                self._ring.remove(user_id)
+            for job in jobs:
+                job.cancelled = True
+            self.counters["cancelled"] += len(jobs)
+            return len(jobs)
+
+    def pending_for(self, user_id: int) -> int:
+        with self._cond:
+            return len(self._pending.get(user_id) or ())
+
+    def stats(self) -> dict:
+        with self._cond:
+            out = dict(self.counters)
+            out.update(pending=self._pending_total(), running=self._busy, users_waiting=len(self._ring))
+        return out
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    # ---------- воркеры ----------
+    def _next_job(self) -> Job | None:
+        for _ in range(len(self._ring)):
+            uid = self._ring[0]
+            self._ring.rotate(-1)            # следующий раз начнём со следующего пользователя
+            if self._running[uid] >= self.per_user_running:
+                continue
+            q = self._pending[uid]
+            job = q.popleft()
+            if not q:
+                del self._pending[uid]
+                self._ring.remove(uid)
+            return job
+        return None
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                job = None
+                while not self._stopped and (job := self._next_job()) is None:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._running[job.user_id] += 1
+                self._busy += 1
+            try:
+                job.fn()
+                ok = True
+            except Exception as e:
+                log.exception("LLM job %s failed: %r", job.id, e)
+                ok = False
+            with self._cond:
+                self._running[job.user_id] -= 1
+                if not self._running[job.user_id]:
+                    del self._running[job.user_id]
+                self._busy -= 1
+                self.counters["done" if ok else "failed"] += 1
+                self._cond.notify_all()   # у пользователя освободился слот
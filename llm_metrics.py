@@ -0,0 +1,183 @@
+"""
+llm_metrics.py — метрики вызовов LLM: кольцевой буфер последних вызовов и сводка по моделям.
+
+Каждая запись: модель, статус, задержка, время до первого байта/токена, токены из usage,
+время TCP/TLS-рукопожатия и признак переиспользованного keep-alive соединения,
+флаги cached / coalesced / fallback. Сводка — p50/p95/p99 задержки, доля ошибок, токены.
+Снимок пишется на диск (LLM_STATS_PATH): *.prom — текстовый формат Prometheus, иначе JSON.
+"""
+
+from __future__ import annotations
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+
+log = logging.getLogger(__name__)
+
+BUFFER_SIZE = int(os.getenv("LLM_STATS_BUFFER", "2000"))
+STATS_PATH = os.getenv("LLM_STATS_PATH", "")
+STATS_INTERVAL_S = float(os.getenv("LLM_STATS_INTERVAL", "60"))
+
+
+@dataclass
+class CallRecord:
+    ts: float
+    model: str
+    status: int
+    latency_ms: int
+    ttfb_ms: int | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    cached: bool = False
+    coalesced: bool = False
+    fallback: bool = False
+    connect_ms: float | None = None   # рукопожатие внутри вызова; 0 — соединение из пула
+    reused: bool | None = None
+
+
+_buf: deque[CallRecord] = deque(maxlen=BUFFER_SIZE)
+_lock = threading.Lock()
+_totals = {"calls": 0, "errors": 0}
+# накопительные (не по окну) число и сумма задержек успешных вызовов upstream по моделям —
+# _count/_sum для summary-метрики Prometheus должны только расти
+_latency_totals: dict[str, list] = {}
+_listeners: list = []
+
+
+def add_listener(fn) -> None:
+    """fn(CallRecord) вызывается после каждой записи (например, llm_autoroute)."""
+    _listeners.append(fn)
+
+
+def record(model: str, status: int, latency_ms: int, *, ttfb_ms: int | None = None,
+           usage: dict | None = None, cached: bool = False, coalesced: bool = False,
+           fallback: bool = False, connect_ms: float | None = None, reused: bool | None = None) -> None:
+    usage = usage or {}
+    rec = CallRecord(time.time(), model, int(status), int(latency_ms), ttfb_ms,
+                     usage.get("prompt_tokens"), usage.get("completion_tokens"),
+                     cached, coalesced, fallback, connect_ms, reused)
+    with _lock:
+        _buf.append(rec)
+        _totals["calls"] += 1
+        if rec.status // 100 != 2:
+            _totals["errors"] += 1
+        elif not (rec.cached or rec.coalesced):
+            acc = _latency_totals.setdefault(model, [0, 0])
+            acc[0] += 1
+            acc[1] += rec.latency_ms
+    for fn in _listeners:
+        try:
+            fn(rec)
+        except Exception as e:
+            log.warning("LLM metrics listener failed: %r", e)
+
+
+def recent(n: int = 50) -> list[dict]:
+    with _lock:
+        return [asdict(r) for r in list(_buf)[-n:]]
+
+
+def _pct(sorted_vals: list[int], p: float) -> int | None:
+    # nearest-rank: без интерполяции, на малых выборках честнее
+    if not sorted_vals:
+        return None
+    k = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100 * len(sorted_vals)) - 1))
+    return sorted_vals[k]
+
+
+def summary() -> dict:
+    """Сводка по моделям за содержимое буфера."""
+    with _lock:
+        records = list(_buf)
+        totals = dict(_totals)
+        latency_totals = {m: tuple(v) for m, v in _latency_totals.items()}
+    by_model: dict[str, list[CallRecord]] = {}
+    for r in records:
+        by_model.setdefault(r.model, []).append(r)
+    models = {}
+    for model, rs in sorted(by_model.items()):
+        # задержку считаем по реальным вызовам upstream: кэш и склейка её бы занизили
+        upstream = [r for r in rs if not (r.cached or r.coalesced)]
+        ok = sorted(r.latency_ms for r in upstream if r.status // 100 == 2)
+        ttfb = sorted(r.ttfb_ms for r in upstream if r.ttfb_ms is not None and r.status // 100 == 2)
+        errors = sum(1 for r in upstream if r.status // 100 != 2)
+        # сколько съедает рукопожатие против самой модели — видно, что даёт keep-alive
+        timed = [r for r in upstream if r.connect_ms is not None and r.status // 100 == 2]
+        models[model] = {
+            "calls": len(rs),
+            "upstream": len(upstream),
+            "errors": errors,
+            "error_rate": round(errors / len(upstream), 3) if upstream else 0.0,
+            "cached": sum(1 for r in rs if r.cached),
+            "coalesced": sum(1 for r in rs if r.coalesced),
+            "fallback": sum(1 for r in rs if r.fallback),
+            "p50_ms": _pct(ok, 50), "p95_ms": _pct(ok, 95), "p99_ms": _pct(ok, 99),
+            "ttfb_p50_ms": _pct(ttfb, 50),
+            "latency_count": latency_totals.get(model, (0, 0))[0],
+            "latency_sum_ms": latency_totals.get(model, (0, 0))[1],
+            "reused": sum(1 for r in upstream if r.reused),
+            "new_connections": sum(1 for r in upstream if r.reused is False),
+            "connect_avg_ms": round(sum(r.connect_ms for r in timed) / len(timed), 1) if timed else None,
+            "model_avg_ms": round(sum(r.latency_ms - r.connect_ms for r in timed) / len(timed), 1) if timed else None,
+            "prompt_tokens": sum(r.prompt_tokens or 0 for r in rs),
+            "completion_tokens": sum(r.completion_tokens or 0 for r in rs),
+        }
+    return {"generated_at": int(time.time()), "window": len(records), "totals": totals, "models": models}
+
+
+def prometheus_text(s: dict | None = None) -> str:
+    s = s or summary()
+    lines = [
+        "# TYPE llm_calls_total counter", f"llm_calls_total {s['totals']['calls']}",
+        "# TYPE llm_errors_total counter", f"llm_errors_total {s['totals']['errors']}",
+    ]
+    gauges = [("calls", "llm_window_calls"), ("errors", "llm_window_errors"),
+              ("error_rate", "llm_window_error_rate"), ("prompt_tokens", "llm_window_prompt_tokens"),
+              ("completion_tokens", "llm_window_completion_tokens")]
+    for field, metric in gauges:
+        lines.append(f"# TYPE {metric} gauge")
+        for model, m in s["models"].items():
+            lines.append(f'{metric}{{model="{model}"}} {m[field]}')
+    # квантили — по окну буфера, _sum/_count — накопительные с запуска процесса
+    lines.append("# TYPE llm_latency_ms summary")
+    for model, m in s["models"].items():
+        for q in ("50", "95", "99"):
+            v = m[f"p{q}_ms"]
+            if v is not None:
+                lines.append(f'llm_latency_ms{{model="{model}",quantile="0.{q}"}} {v}')
+        lines.append(f'llm_latency_ms_sum{{model="{model}"}} {m["latency_sum_ms"]}')
+        lines.append(f'llm_latency_ms_count{{model="{model}"}} {m["latency_count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(path: str = STATS_PATH) -> str | None:
+    """Пишет снимок атомарно (через временный файл). Вернёт путь или None, если путь не задан."""
+    if not path:
+        return None
+    s = summary()
+    body = prometheus_text(s) if path.endswith(".prom") else json.dumps(s, ensure_ascii=False, indent=2)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(body)
+    os.replace(tmp, path)
+    return path
+
+
+def start_snapshot_writer(path: str = STATS_PATH, interval_s: float = STATS_INTERVAL_S) -> None:
+    if not path:
+        return
+
+    def loop() -> None:
+        while True:
+            time.sleep(interval_s)
+            try:
+                write_snapshot(path)
+            except Exception as e:
+                log.warning("LLM stats snapshot failed: %r", e)
+
+    threading.Thread(target=loop, name="llm-stats", daemon=True).start()
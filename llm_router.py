@@ -0,0 +1,267 @@
+"""
+llm_router.py — устойчивый вызов OpenRouter поверх openrouter_client.
+
+  - повторы с «джиттером» (full jitter) и уважением к Retry-After;
+  - circuit breaker на каждую модель: после N ошибок подряд модель выключается
+    на cooldown, затем пропускается один пробный запрос (half-open);
+  - цепочка моделей: если текущая не ответила — следующая по таблице models.
+
+Ограничения хвоста: не больше MAX_FALLBACKS запасных моделей и общий бюджет времени
+BUDGET_S на все попытки, паузы и переключения вместе.
+
+401 (неверный ключ) и прочие 4xx, кроме 408/429 и 403/404, — ошибка самого запроса: её не лечит
+ни повтор, ни другая модель, поэтому отдаём сразу и breaker не трогаем.
+403/404 — ошибка конкретной модели (нет доступа, модель убрали): её не повторяем,
+но переходим к следующей в цепочке.
+
+Пробный запрос half-open breaker-а освобождается при любом выходе из попытки: успех или
+ошибка модели его разрешают, а ошибка запроса, нехватка бюджета или чужое исключение —
+просто возвращают, иначе модель навсегда выпала бы из цепочки до перезапуска.
+"""
+
+from __future__ import annotations
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import llm_metrics
+from openrouter_client import OpenRouterError, chat_once, chat_stream, last_timing
+
+log = logging.getLogger(__name__)
+
+RETRYABLE = {408, 429, 500, 502, 503, 504}
+FATAL = {401}
+MODEL_ERRORS = {403, 404}   # не повторяем, но пробуем следующую модель
+
+MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "2"))          # попыток на одну модель
+BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+BACKOFF_CAP_S = float(os.getenv("LLM_BACKOFF_CAP", "8"))
+MAX_RETRY_AFTER_S = float(os.getenv("LLM_MAX_RETRY_AFTER", "10"))  # дольше ждать не станем — лучше другая модель
+BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+MAX_FALLBACKS = int(os.getenv("LLM_MAX_FALLBACKS", "2"))         # запасных моделей после основной
+BUDGET_S = float(os.getenv("LLM_BUDGET", "45"))                  # на весь /ask, с повторами и переключениями
+MIN_ATTEMPT_S = 1.0                                              # меньше остатка бюджета — не начинаем попытку
+
+
+def terminal(status: int) -> bool:
+    """Ошибка запроса, а не модели: повторять и переключаться бессмысленно."""
+    return status in FATAL or (400 <= status < 500 and status not in RETRYABLE and status not in MODEL_ERRORS)
+
+
+def _budget_error() -> OpenRouterError:
+    return OpenRouterError(408, "Модели не ответили за отведённое время.")
+
+
+# ---------- circuit breaker ----------
+class CircuitBreaker:
+    """closed → (threshold ошибок подряд) → open → (cooldown) → half-open → closed/open."""
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown_s: float = BREAKER_COOLDOWN_S):
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown_s:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True   # ровно один пробный запрос
+                return True
+            return False
+
+    def release(self) -> None:
+        """Вернуть пробный запрос без вердикта (попытка не дошла до модели или упала не по её вине)."""
+        with self._lock:
+            self._trial = False
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        b = _breakers.get(model)
+        if b is None:
+            b = _breakers[model] = CircuitBreaker()
+        return b
+
+
+def breaker_states() -> Dict[str, str]:
+    with _breakers_lock:
+        return {m: b.state for m, b in _breakers.items()}
+
+
+# ---------- повторы ----------
+def _backoff(attempt: int, err: OpenRouterError) -> float | None:
+    """Пауза перед следующей попыткой или None, если повторять эту модель не стоит."""
+    if err.status not in RETRYABLE or attempt + 1 >= MAX_ATTEMPTS:
+        return None
+    if err.retry_after is not None:
+        return err.retry_after if err.retry_after <= MAX_RETRY_AFTER_S else None
+    return random.uniform(0, min(BACKOFF_CAP_S, BACKOFF_BASE_S * (2 ** attempt)))
+
+
+def _record(model: str, status: int, fallback: bool) -> None:
+    t = last_timing()
+    llm_metrics.record(model, status, t.get("total_ms", 0),
+                       ttfb_ms=t.get("ttfb_ms", t.get("ttft_ms")), usage=t.get("usage"), fallback=fallback,
+                       connect_ms=t.get("connect_ms"), reused=t.get("reused"))
+
+
+def _call_model(model: str, fn, deadline: float, *, fallback: bool = False, record_success: bool = True):
+    """
+    fn(timeout_s) с повторами для одной модели; timeout каждой попытки — не больше остатка
+    бюджета до deadline (time.monotonic). Ошибки учитываются в её breaker и в метриках.
+    """
+    b = breaker(model)
+    attempt = 0
+    resolved = False   # success()/failure() уже вызваны — пробный запрос разрешён
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining < MIN_ATTEMPT_S:
+                raise _budget_error()
+            try:
+                result = fn(remaining)
+            except OpenRouterError as e:
+                _record(model, e.status, fallback)
+                if terminal(e.status):
+                    raise
+                b.failure()
+                resolved = True
+                delay = _backoff(attempt, e)
+                if delay is None or time.monotonic() + delay + MIN_ATTEMPT_S > deadline or not b.allow():
+                    raise
+                resolved = False   # allow() мог снова выдать пробный запрос
+                log.info("Retry %s in %.2fs after [%s]", model, delay, e.status)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            b.success()
+            resolved = True
+            if record_success:
+                _record(model, 200, fallback)
+            return result
+    finally:
+        if not resolved:
+            b.release()
+
+
+def _chain(models: List[str]) -> Iterator[str]:
+    # allow() спрашиваем лениво — только у модели, до которой дошла очередь:
+    # иначе half-open модели тратили бы пробный запрос впустую
+    tried = 0
+    for m in models:
+        if tried > MAX_FALLBACKS:
+            return
+        if breaker(m).allow():
+            tried += 1
+            yield m
+    if not tried and models:
+        yield models[0]  # все выключены — пробуем первую (лучше, чем ничего)
+
+
+def chat_with_fallback(messages: List[Dict], models: List[str], *, budget_s: float = BUDGET_S,
+                       **kwargs) -> Tuple[str, int, str]:
+    """(text, dt_ms, модель, которая ответила). dt_ms — суммарно, с повторами и переключениями."""
+    t0 = time.perf_counter()
+    deadline = time.monotonic() + budget_s
+    cap = kwargs.pop("timeout_s", 30)
+    last_err: OpenRouterError | None = None
+    for model in _chain(models):
+        try:
+            text, _ = _call_model(model, lambda t: chat_once(messages, model=model, timeout_s=min(t, cap), **kwargs),
+                                  deadline, fallback=model != models[0])
+        except OpenRouterError as e:
+            if terminal(e.status):
+                raise
+            log.warning("Model %s failed [%s], falling back", model, e.status)
+            last_err = e
+            if deadline - time.monotonic() < MIN_ATTEMPT_S:
+                break
+            continue
+        return text, int((time.perf_counter() - t0) * 1000), model
+    raise last_err or OpenRouterError(503, "Нет доступных моделей.")
+
+
+class FallbackStream:
+    """
+    Поток токенов с переключением моделей. Переключаться можно только до первого
+    токена: дальше пользователь уже видит ответ, и ошибка отдаётся как есть.
+    После первого токена self.model — модель, которая отвечает.
+    Бюджет budget_s действует до первого токена; дальше timeout_s ограничивает паузу между кусками.
+    """
+
+    def __init__(self, messages: List[Dict], models: List[str], *, budget_s: float = BUDGET_S, **kwargs):
+        self.messages = messages
+        self.models = models
+        self.budget_s = budget_s
+        self.kwargs = kwargs
+        self.model: str | None = None
+
+    def _open(self, model: str, timeout_s: float) -> Tuple[str, Iterator[str]]:
+        # первый токен получаем внутри повторов; остаток потока отдаём как есть
+        kwargs = dict(self.kwargs)
+        kwargs["timeout_s"] = min(timeout_s, kwargs.get("timeout_s", 30))
+        it = chat_stream(self.messages, model=model, **kwargs)
+        return next(it, ""), it
+
+    def __iter__(self) -> Iterator[str]:
+        deadline = time.monotonic() + self.budget_s
+        last_err: OpenRouterError | None = None
+        for model in _chain(self.models):
+            try:
+                # успех пишем в метрики после конца потока — тогда известны полная задержка и usage
+                first, rest = _call_model(model, lambda t: self._open(model, t), deadline,
+                                          fallback=model != self.models[0], record_success=False)
+            except OpenRouterError as e:
+                if terminal(e.status):
+                    raise
+                log.warning("Model %s failed [%s], falling back", model, e.status)
+                last_err = e
+                if deadline - time.monotonic() < MIN_ATTEMPT_S:
+                    break
+                continue
+            self.model = model
+            if first:
+                yield first
+            try:
+                yield from rest
+            except OpenRouterError as e:
+                breaker(model).failure()
+                _record(model, e.status, model != self.models[0])
+                raise
+            _record(model, 200, model != self.models[0])
+            return
+        raise last_err or OpenRouterError(503, "Нет доступных моделей.")
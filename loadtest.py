@@ -0,0 +1,592 @@
+"""
+loadtest.py — сквозной нагрузочный прогон бота без настоящих Telegram и OpenRouter.
+
+Поднимает один локальный HTTP-сервер с двумя «заглушками»:
+  - Bot API (/bot<token>/<method>): отдаёт синтетические апдейты пачками через getUpdates
+    и записывает sendMessage / editMessageText / sendDocument и прочие вызовы;
+  - OpenRouter (/openrouter/chat/completions): ответ с настраиваемой задержкой,
+    долей ошибок (500/429) и потоковым режимом (SSE).
+
+Бот (main2.py или main3.py) запускается отдельным процессом без изменений: адрес Bot API
+подменяется через telebot.apihelper.API_URL, адрес OpenRouter — через OPENROUTER_API_URL.
+Задержка обработчика — от выдачи апдейта (в getUpdates или POST на webhook) до первого
+ответа бота на него: reply_to на это сообщение (или правка сообщения с нажатой кнопкой)
+в том же чате. Ответ «Ошибка…» считается неудачей (failed), а не ответом; код возврата 2,
+если есть неудачи или апдейты без ответа. Сценарий main2.py заранее заводит каждому
+пользователю по SEED_NOTES заметок, чтобы /note_edit, /note_del, /note_export и листание
+списка кнопками работали с настоящими id; час рассылки main3.py уводится от текущего, чтобы
+её сообщения не смешивались с ответами.
+--mode webhook запускает бота с BOT_MODE=webhook (см. webhook.py) и шлёт апдейты ему
+напрямую, как это делает Telegram.
+
+Пример:
+    python loadtest.py main2.py --updates 2000 --users 300 --llm-latency-ms 400 --llm-errors 0.05
+    python loadtest.py main3.py --updates 5000 --rate 200 --out bench_output.txt
+    python loadtest.py main2.py --mode webhook --updates 2000
+
+Цель openrouter_async гоняет только chat_once_async против заглушки OpenRouter (в этом же
+процессе, без бота): --updates запросов по --concurrency параллельно, двумя event loop подряд —
+так проверяются общий пул соединений, пересоздание сессии при смене loop и то, что любые
+ошибки (и введённые --llm-errors) приходят как OpenRouterError:
+    python loadtest.py openrouter_async --updates 500 --concurrency 50 --llm-errors 0.1
+"""
+
+from __future__ import annotations
+import argparse
+import email.policy
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN = "123456:LOADTEST"
+WEBHOOK_SECRET = "loadtest-secret"
+
+# сценарии: (вес, генератор). Генератор получает (rng, uid, notes) и возвращает текст команды
+# или {"callback": data} для нажатия inline-кнопки. notes — заранее заведённые заметки
+# пользователя (см. _seed_notes): /note_edit и /note_del бьют в существующие id, а удаляемые
+# id не пересекаются с редактируемыми — иначе гонка двух апдейтов давала бы «не найдена».
+WORDS = "молоко встреча отчёт проект идея книга фильм спорт врач подарок python".split()
+SEED_NOTES = 8          # заметок на пользователя до начала прогона (main2.py)
+
+
+def _words(r: random.Random, lo: int = 2, hi: int = 8) -> str:
+    return " ".join(r.choice(WORDS) for _ in range(r.randint(lo, hi)))
+
+
+def _note_edit(r: random.Random, uid: int, notes: dict) -> str:
+    return f"/note_edit {r.choice(notes['edit'])} {_words(r)}" if notes.get("edit") else "/note_count"
+
+
+def _note_del(r: random.Random, uid: int, notes: dict) -> str:
+    return f"/note_del {notes['del'].popleft()}" if notes.get("del") else "/note_count"
+
+
+def _notes_page(r: random.Random, uid: int, notes: dict) -> dict:
+    # «Старше ➡️» от курсора за последней заметкой — первая страница списка
+    return {"callback": f"notes:{uid}:o:{notes.get('top', 0) + 1}"}
+
+
+def _quiet_hour(r: random.Random) -> int:
+    # час рассылки не должен наступить во время прогона: иначе её сообщения смешаются с ответами
+    busy = {time.localtime().tm_hour, (time.localtime().tm_hour + 1) % 24}
+    return r.choice([h for h in range(24) if h not in busy])
+
+
+SCENARIOS = {
+    "main2.py": [
+        (26, lambda r, u, n: "/note_add " + _words(r)),
+        (14, lambda r, u, n: "/note_list"),
+        (8, _notes_page),
+        (12, lambda r, u, n: "/note_find " + r.choice(WORDS)),
+        (6, _note_edit),
+        (4, _note_del),
+        (4, lambda r, u, n: "/note_count"),
+        (4, lambda r, u, n: "/note_export " + r.choice(["txt", "csv", "jsonl gz"])),
+        (5, lambda r, u, n: "/note_stats"),
+        (8, lambda r, u, n: "/help"),
+        (5, lambda r, u, n: "/ask что такое " + r.choice(WORDS) + "?"),
+    ],
+    "main3.py": [
+        (10, lambda r, u, n: "/start"),
+        (20, lambda r, u, n: "/set_sign " + r.choice(["овен", "лев", "дева", "рыбы", "весы"])),
+        (15, lambda r, u, n: f"/set_time {_quiet_hour(r)}"),
+        (20, lambda r, u, n: "/me"),
+        (20, lambda r, u, n: "/today"),
+        (10, lambda r, u, n: "/signs"),
+        (5, lambda r, u, n: "/subscribe"),
+    ],
+}
+# ответы бота, которые считаем неудачей, а не ответом
+ERROR_PREFIXES = ("Ошибка", "Непредвиденная ошибка")
+# команды, на которые бот отвечает не reply_to, а send_message/send_document в чат:
+# исходящее без адресата сопоставляем только с ними
+UNTHREADED = {"/note_export", "/start", "/today"}
+# «⏳ Думаю…» потокового /ask — ещё не ответ: ответом считаем первую правку этого сообщения
+PLACEHOLDER_PREFIX = "⏳"
+
+
+def _seed_notes(db_path: str, users: range) -> dict[int, dict]:
+    """Заводит SEED_NOTES заметок каждому пользователю прямо в базе бота (до его запуска)."""
+    os.environ["DB_PATH"] = db_path
+    import db
+    import storage
+    db.init_db()
+    out = {}
+    for uid in users:
+        ids = [db.add_note(uid, f"заготовка {i} {WORDS[i % len(WORDS)]}") for i in range(SEED_NOTES)]
+        half = len(ids) // 2
+        out[uid] = {"edit": ids[:half], "del": deque(ids[half:]), "top": ids[-1]}
+    storage.close_all()
+    return out
+
+
+def _parse_multipart(content_type: str, body: bytes) -> dict:
+    """Поля multipart/form-data (так telebot шлёт sendDocument); у файлов — имя и размер."""
+    msg = BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    out = {}
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if not name:
+            continue
+        data = part.get_payload(decode=True) or b""
+        if part.get_filename():
+            out[name] = {"file_name": part.get_filename(), "file_size": len(data)}
+        else:
+            out[name] = data.decode("utf-8", "replace")
+    return out
+
+
+def _pct(vals: list[float], p: float) -> float | None:
+    if not vals:
+        return None
+    k = max(0, min(len(vals) - 1, math.ceil(p / 100 * len(vals)) - 1))
+    return round(vals[k], 2)
+
+
+class FakeWorld:
+    """Общее состояние заглушек: очередь апдейтов, ожидающие ответа сообщения, счётчики."""
+
+    def __init__(self, *, llm_latency_ms: float, llm_errors: float, llm_token_ms: float, seed: int):
+        self.cond = threading.Condition()
+        self.updates: deque[dict] = deque()       # выпущены, ещё не подтверждены offset-ом
+        self.delivered_at: dict[int, float] = {}  # update_id -> время первой выдачи
+        self.waiting: dict[int, deque] = {}       # chat_id -> [(message_id, update_id, command)]
+        self.latency: list[tuple[str, float]] = []
+        self.failed: Counter[str] = Counter()     # команда -> ответов с ошибкой
+        self.unmatched: Counter[str] = Counter()  # метод -> исходящих, не ответивших ни на один апдейт
+        self.placeholders: dict[int, tuple] = {}  # message_id заглушки -> ожидающий апдейт
+        self.calls: Counter[str] = Counter()
+        self.llm = Counter()
+        self.ready = threading.Event()
+        self.next_message_id = 10_000_000
+        self.llm_latency_ms = llm_latency_ms
+        self.llm_errors = llm_errors
+        self.llm_token_ms = llm_token_ms
+        self.rng = random.Random(seed)
+        self.first_delivery: float | None = None
+        self.last_answer: float | None = None
+
+    # ---------- Bot API ----------
+    def release(self, update: dict) -> None:
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def get_updates(self, offset: int | None, limit: int, timeout: float) -> list[dict]:
+        deadline = time.monotonic() + min(timeout, 1.0)
+        with self.cond:
+            if offset is not None and offset < 0:
+                # skip_pending: бот сбрасывает старые апдейты; нагрузку ещё не выпускали
+                return []
+            self.ready.set()
+            while True:
+                while self.updates and offset is not None and self.updates[0]["update_id"] < offset:
+                    self.updates.popleft()
+                batch = list(self.updates)[:limit]
+                if batch:
+                    for u in batch:
+                        self._delivered(u)
+                    return batch
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self.cond.wait(left)
+
+    def _delivered(self, u: dict) -> None:
+        # вызывается под self.cond; повторная выдача того же апдейта время не сбрасывает
+        if u["update_id"] in self.delivered_at:
+            return
+        now = time.perf_counter()
+        self.delivered_at[u["update_id"]] = now
+        if "callback_query" in u:
+            # ответ на нажатие — правка того сообщения, под которым кнопка
+            m = u["callback_query"]["message"]
+            command = "callback:" + u["callback_query"]["data"].split(":", 1)[0]
+        else:
+            m = u["message"]
+            command = m["text"].split()[0]
+        self.waiting.setdefault(m["chat"]["id"], deque()).append((m["message_id"], u["update_id"], command))
+        if self.first_delivery is None:
+            self.first_delivery = now
+
+    def delivered(self, u: dict) -> None:
+        with self.cond:
+            self._delivered(u)
+
+    def outbound(self, method: str, params: dict):
+        now = time.perf_counter()
+        chat_id = params.get("chat_id")
+        # на какое сообщение пользователя это ответ: reply_parameters у send*, message_id у правки
+        target = None
+        if method == "editMessageText":
+            target = int(params["message_id"]) if str(params.get("message_id", "")).isdigit() else None
+        elif "reply_parameters" in params:
+            try:
+                target = json.loads(params["reply_parameters"]).get("message_id")
+            except ValueError:
+                pass
+        text = params.get("text") or params.get("caption") or ""
+        with self.cond:
+            self.calls[method] += 1
+            self.next_message_id += 1
+            mid = self.next_message_id
+            if chat_id is not None and method != "answerCallbackQuery":
+                q = self.waiting.get(int(chat_id))
+                # только ожидающие апдейты этого же чата; явный адресат — только он сам.
+                # Без адресата — самый старый ожидающий в чате из UNTHREADED
+                if method == "editMessageText" and target in self.placeholders:
+                    item = self.placeholders.pop(target)
+                elif target is not None:
+                    item = next((x for x in q or () if x[0] == target), None)
+                else:
+                    item = next((x for x in q or () if x[2] in UNTHREADED), None)
+                if item is None:
+                    self.unmatched[method] += 1   # рассылка, очередная правка потокового ответа и т.п.
+                elif text.startswith(PLACEHOLDER_PREFIX):
+                    q.remove(item)
+                    self.placeholders[mid] = item
+                else:
+                    if item in (q or ()):
+                        q.remove(item)
+                    if text.startswith(ERROR_PREFIXES):
+                        self.failed[item[2]] += 1
+                    else:
+                        self.latency.append((item[2], (now - self.delivered_at[item[1]]) * 1000))
+                    self.last_answer = now
+                    self.cond.notify_all()
+        if chat_id is None:
+            return True
+        msg = {"message_id": mid, "date": int(time.time()),
+               "chat": {"id": int(chat_id), "type": "private"},
+               "from": {"id": 1, "is_bot": True, "first_name": "loadtest"}}
+        if method == "editMessageText" and target is not None:
+            msg["message_id"] = target
+        if isinstance(params.get("document"), dict):
+            msg["document"] = {"file_id": f"doc{mid}", "file_unique_id": f"doc{mid}", **params["document"]}
+            msg["caption"] = params.get("caption", "")
+        else:
+            msg["text"] = text
+        return msg
+
+    def answered(self) -> int:
+        """Сколько апдейтов получили ответ — успешный или с ошибкой."""
+        with self.cond:
+            return len(self.latency) + sum(self.failed.values())
+
+    # ---------- OpenRouter ----------
+    def llm_plan(self) -> tuple[int | None, float]:
+        with self.cond:
+            self.llm["requests"] += 1
+            if self.rng.random() < self.llm_errors:
+                status = self.rng.choice([500, 502, 429])
+                self.llm[f"error_{status}"] += 1
+                return status, 0.0
+            return None, self.llm_latency_ms * self.rng.uniform(0.5, 1.5) / 1000
+
+
+def _make_handler(world: FakeWorld):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def _body(self) -> bytes:
+            n = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(n) if n else b""
+
+        def _json(self, obj, status: int = 200, headers: dict | None = None) -> None:
+            data = json.dumps(obj, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            self.do_POST()
+
+        def do_POST(self) -> None:
+            url = urlparse(self.path)
+            body = self._body()
+            if url.path.startswith("/openrouter/"):
+                return self._openrouter(body)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            ctype = self.headers.get("Content-Type", "")
+            if ctype.startswith("application/x-www-form-urlencoded"):
+                params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+            elif ctype.startswith("multipart/form-data"):
+                params.update(_parse_multipart(ctype, body))
+            method = url.path.rsplit("/", 1)[-1]
+            if method == "getUpdates":
+                offset = int(params["offset"]) if "offset" in params else None
+                result = world.get_updates(offset, int(params.get("limit", 100)), float(params.get("timeout", 0)))
+            elif method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+            else:
+                result = world.outbound(method, params)
+            self._json({"ok": True, "result": result})
+
+        def _openrouter(self, body: bytes) -> None:
+            payload = json.loads(body or b"{}")
+            status, delay = world.llm_plan()
+            if status is not None:
+                return self._json({"error": {"code": status, "message": "injected"}}, status,
+                                  {"Retry-After": "0"} if status == 429 else None)
+            time.sleep(delay)
+            tokens = ["Это ", "ответ ", "заглушки ", "для ", "нагрузочного ", "прогона."]
+            usage = {"prompt_tokens": 50, "completion_tokens": len(tokens), "total_tokens": 50 + len(tokens)}
+            if not payload.get("stream"):
+                return self._json({"choices": [{"message": {"role": "assistant", "content": "".join(tokens)}}],
+                                   "usage": usage})
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for t in tokens:
+                self.wfile.write(f"data: {json.dumps({'choices': [{'delta': {'content': t}}]})}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(world.llm_token_ms / 1000)
+            self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n".encode())
+            self.close_connection = True
+
+    return Handler
+
+
+def _wait_healthy(hook_url: str, world: FakeWorld, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(hook_url + "/healthz", timeout=1) as r:
+                if r.status == 200:
+                    world.ready.set()
+                    return
+        except OSError:
+            time.sleep(0.1)
+
+
+def _post_update(hook_url: str, update: dict, world: FakeWorld) -> None:
+    req = urllib.request.Request(hook_url + "/telegram", data=json.dumps(update).encode(), method="POST",
+                                 headers={"Content-Type": "application/json",
+                                          "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+    # время выдачи — до запроса: в задержку входит и приём апдейта ботом
+    world.delivered(update)
+    try:
+        urllib.request.urlopen(req, timeout=10).close()
+    except OSError as e:
+        print(f"webhook POST failed: {e!r}", file=sys.stderr)
+
+
+def _run_async_client(base: str, world: FakeWorld, *, requests: int, concurrency: int) -> dict:
+    """Два прогона chat_once_async (каждый в своём asyncio.run) против заглушки OpenRouter."""
+    import asyncio
+    os.environ["OPENROUTER_API_URL"] = f"{base}/openrouter/chat/completions"
+    os.environ["OPENROUTER_API_KEY"] = "loadtest"
+    import openrouter_client as oc
+
+    async def one_loop(n: int) -> tuple[list[float], Counter]:
+        sem = asyncio.Semaphore(concurrency)
+        lat: list[float] = []
+        outcome: Counter[str] = Counter()
+
+        async def call(i: int) -> None:
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    await oc.chat_once_async([{"role": "user", "content": f"вопрос {i}"}], model="stub")
+                    lat.append((time.perf_counter() - t0) * 1000)
+                    outcome["ok"] += 1
+                except oc.OpenRouterError as e:
+                    outcome[f"error_{e.status}"] += 1
+                except Exception as e:   # всё, что не OpenRouterError, — ошибка клиента
+                    outcome[f"unexpected_{type(e).__name__}"] += 1
+
+        await asyncio.gather(*(call(i) for i in range(n)))
+        return lat, outcome
+
+    lat: list[float] = []
+    outcome: Counter[str] = Counter()
+    half = requests // 2
+    t0 = time.perf_counter()
+    # второй asyncio.run — новый loop: сессия первого должна закрыться и пересоздаться
+    for n in (half, requests - half):
+        l, o = asyncio.run(one_loop(n))
+        lat += l
+        outcome += o
+    asyncio.run(oc.close_async_session())
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return {
+        "bot": "openrouter_async", "requests": requests, "concurrency": concurrency,
+        "elapsed_s": round(wall, 3), "requests_per_s": round(requests / wall, 1) if wall > 0 else None,
+        "p50_ms": _pct(lat, 50), "p99_ms": _pct(lat, 99),
+        "outcome": dict(outcome), "llm": dict(world.llm),
+    }
+
+
+# бот запускается как есть; меняется только адрес Bot API внутри telebot
+_BOOT = """
+import runpy, sys
+import telebot.apihelper as apihelper
+apihelper.API_URL = sys.argv[1]
+sys.argv = sys.argv[2:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("bot", choices=sorted(SCENARIOS) + ["openrouter_async"], help="какой бот гонять")
+    ap.add_argument("--mode", choices=("polling", "webhook"), default="polling", help="как бот получает апдейты")
+    ap.add_argument("--webhook-connections", type=int, default=8, help="параллельных POST на webhook")
+    ap.add_argument("--updates", type=int, default=1000, help="сколько апдейтов выпустить")
+    ap.add_argument("--users", type=int, default=200, help="разных пользователей (чатов)")
+    ap.add_argument("--rate", type=float, default=0, help="апдейтов в секунду (0 — все сразу)")
+    ap.add_argument("--llm-latency-ms", type=float, default=300, help="средняя задержка заглушки OpenRouter")
+    ap.add_argument("--llm-token-ms", type=float, default=20, help="пауза между токенами в потоковом режиме")
+    ap.add_argument("--llm-errors", type=float, default=0.0, help="доля ответов OpenRouter с ошибкой (0..1)")
+    ap.add_argument("--concurrency", type=int, default=50, help="параллельных запросов для openrouter_async")
+    ap.add_argument("--timeout", type=float, default=60, help="сколько ждать ответы после выпуска всех апдейтов")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default=None, help="куда записать JSON-отчёт (по умолчанию только stdout)")
+    args = ap.parse_args(argv)
+
+    world = FakeWorld(llm_latency_ms=args.llm_latency_ms, llm_errors=args.llm_errors,
+                      llm_token_ms=args.llm_token_ms, seed=args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(world))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-apis", daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    if args.bot == "openrouter_async":
+        try:
+            report = _run_async_client(base, world, requests=args.updates, concurrency=args.concurrency)
+        finally:
+            server.shutdown()
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        bad = sum(v for k, v in report["outcome"].items() if k.startswith("unexpected_"))
+        return 2 if bad or report["outcome"].get("ok", 0) == 0 else 0
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmp = tempfile.TemporaryDirectory(prefix="loadtest_")
+    user_ids = range(1_000, 1_000 + args.users)
+    notes = {uid: {} for uid in user_ids}
+    if args.bot == "main2.py":
+        notes = _seed_notes(os.path.join(tmp.name, "bot.db"), user_ids)
+    env = dict(os.environ,
+               TOKEN=TOKEN,
+               DB_PATH=os.path.join(tmp.name, "bot.db"),
+               OPENROUTER_API_URL=f"{base}/openrouter/chat/completions",
+               OPENROUTER_API_KEY="loadtest",
+               LLM_BACKOFF_BASE="0.05",
+               # час рассылки по умолчанию — подальше от текущего (см. _quiet_hour)
+               DEFAULT_NOTIFY_HOUR=str((time.localtime().tm_hour + 12) % 24),
+               BOT_MODE=args.mode)
+    hook_url = None
+    if args.mode == "webhook":
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            hook_port = sock.getsockname()[1]
+        env.update(WEBHOOK_URL="", WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(hook_port),
+                   WEBHOOK_PATH="/telegram", WEBHOOK_SECRET=WEBHOOK_SECRET)
+        hook_url = f"http://127.0.0.1:{hook_port}"
+    proc = subprocess.Popen([sys.executable, "-c", _BOOT, base + "/bot{0}/{1}", args.bot],
+                            cwd=here, env=env)
+    rc = 0
+    posters = ThreadPoolExecutor(max_workers=args.webhook_connections, thread_name_prefix="webhook-post")
+    try:
+        if hook_url is not None:
+            _wait_healthy(hook_url, world, 30)
+        if not world.ready.wait(30):
+            print("Бот не начал принимать апдейты за 30 с", file=sys.stderr)
+            return 1
+
+        rng = random.Random(args.seed)
+        weights = [w for w, _ in SCENARIOS[args.bot]]
+        makers = [m for _, m in SCENARIOS[args.bot]]
+        t_start = time.perf_counter()
+        for i in range(args.updates):
+            if args.rate > 0:
+                delay = t_start + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            uid = 1_000 + rng.randrange(args.users)
+            made = rng.choices(makers, weights)[0](rng, uid, notes[uid])
+            user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+            chat = {"id": uid, "type": "private"}
+            if isinstance(made, dict):
+                # нажатие кнопки под «списком», который бот якобы прислал раньше
+                update = {"update_id": i + 1, "callback_query": {
+                    "id": str(i + 1), "from": user, "chat_instance": str(uid), "data": made["callback"],
+                    "message": {"message_id": 5_000_000 + i, "date": int(time.time()), "chat": chat,
+                                "from": {"id": 1, "is_bot": True, "first_name": "loadtest"}, "text": "📝"},
+                }}
+            else:
+                update = {"update_id": i + 1, "message": {
+                    "message_id": i + 1, "date": int(time.time()), "text": made, "chat": chat, "from": user,
+                }}
+            if hook_url is None:
+                world.release(update)
+            else:
+                posters.submit(_post_update, hook_url, update, world)
+
+        deadline = time.monotonic() + args.timeout
+        while world.answered() < args.updates and time.monotonic() < deadline and proc.poll() is None:
+            time.sleep(0.1)
+    finally:
+        posters.shutdown(wait=False, cancel_futures=True)
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        server.shutdown()
+        tmp.cleanup()
+
+    lat = sorted(ms for _, ms in world.latency)
+    by_cmd: dict[str, list[float]] = {}
+    for cmd, ms in world.latency:
+        by_cmd.setdefault(cmd, []).append(ms)
+    span = (world.last_answer or 0) - (world.first_delivery or 0)
+    report = {
+        "bot": args.bot, "mode": args.mode, "updates": args.updates, "answered": len(lat),
+        "failed": sum(world.failed.values()), "unanswered": args.updates - len(lat) - sum(world.failed.values()),
+        "users": args.users, "rate": args.rate,
+        "elapsed_s": round(span, 3), "updates_per_s": round(len(lat) / span, 1) if span > 0 else None,
+        "p50_ms": _pct(lat, 50), "p99_ms": _pct(lat, 99), "max_ms": round(lat[-1], 2) if lat else None,
+        "by_command": {cmd: {"n": len(v), "failed": world.failed[cmd],
+                             "p50_ms": _pct(sorted(v), 50), "p99_ms": _pct(sorted(v), 99)}
+                       for cmd, v in sorted(by_cmd.items())},
+        "failed_by_command": dict(world.failed),
+        "unanswered_by_command": dict(Counter(cmd for q in world.waiting.values() for _, _, cmd in q)),
+        "api_calls": dict(world.calls),
+        "unmatched_calls": dict(world.unmatched),
+        "llm": dict(world.llm),
+    }
+    body = json.dumps(report, ensure_ascii=False, indent=2)
+    print(body)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(body + "\n")
+    if report["unanswered"] or report["failed"]:
+        rc = 2
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,11 +8,14 @@ import telebot
 from telebot import types
 import logging
 
+from runmode import BOT_THREADS
+from webhook import run_bot
+
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 if not TOKEN:
     raise RuntimeError("В .env нет TOKEN")
-bot = telebot.TeleBot(TOKEN)
+bot = telebot.TeleBot(TOKEN, num_threads=BOT_THREADS)
 
 @bot.message_handler(commands=['start'])
 def start(m: types.Message) -> None:
@@ -162,5 +165,5 @@ def fetch_weather_moscow_open_meteo() -> str:
         return "Не удалось получить погоду."
 
 if __name__ == "__main__":
-    bot.infinity_polling(skip_pending=True)
+    run_bot(bot, skip_pending=True)
 
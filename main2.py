@@ -1,14 +1,29 @@
 import os
+import html
+import logging
 from dotenv import load_dotenv
 import telebot
 import time
-from datetime import datetime, timedelta
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
 
 from telebot import types
 
-from db import init_db, add_note, list_notes, update_note, delete_note, find_notes, list_models, get_active_model, \
-    set_active_model
-from openrouter_client import chat_once, OpenRouterError
+from db import init_db, add_note_limited, count_notes, update_note, delete_note, find_notes, list_models, \
+    notes_page, note_activity, STATS_RANGES, get_active_model, \
+    set_active_model, get_routing_mode, set_routing_mode, SNIPPET_OPEN, SNIPPET_CLOSE
+from openrouter_client import last_timing, pool_stats, OpenRouterError
+from llm_router import chat_with_fallback, FallbackStream, BUDGET_S
+from llm_jobs import FairJobQueue, QueueFullError
+import chat_memory
+import llm_metrics
+import llm_autoroute
+from llm_cache import response_cache, inflight, make_key
+from notes_export import export_notes, FORMATS
+from runmode import BOT_THREADS
+from webhook import run_bot
+
+log = logging.getLogger(__name__)
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -16,13 +31,25 @@ TOKEN = os.getenv("TOKEN")
 if not TOKEN:
     raise RuntimeError("В .env файле нет TOKEN")
 
-bot = telebot.TeleBot(TOKEN)
+bot = telebot.TeleBot(TOKEN, num_threads=BOT_THREADS)
 
 # Инициализация базы данных при запуске
 init_db()
 
 # Константы
 MAX_NOTES_PER_USER = 50
+NOTES_PAGE_SIZE = 10
+NOTE_PREVIEW_CHARS = 300      # 10 × 300 символов гарантированно влезают в одно сообщение
+TG_TEXT_LIMIT = 4000          # запас до лимита Telegram в 4096 символов
+ASK_STREAM = os.getenv("ASK_STREAM", "1") == "1"
+ASK_TEMPERATURE = 0.2
+ASK_MAX_TOKENS = 400
+STREAM_EDIT_INTERVAL_S = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+ASK_WORKERS = int(os.getenv("ASK_WORKERS", "4"))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.isdigit()}
+
+# Отдельный пул для LLM: медленные модели не занимают потоки обработчиков telebot
+ask_jobs = FairJobQueue(workers=ASK_WORKERS)
 
 
 @bot.message_handler(commands=['start'])
@@ -36,15 +63,18 @@ def help_cmd(message):
 Доступные команды:
 /note_add <текст> - Добавить заметку (максимум {MAX_NOTES_PER_USER})
 /note_list - Показать все заметки
-/note_find <запрос> - Найти заметку
+/note_find <запрос> - Найти заметку (по началу слов: «прив» найдёт «Привет», «ивет» — нет)
 /note_edit <id> <новый текст> - Изменить заметку
 /note_del <id> - Удалить заметку
 /note_count - Количество заметок
-/note_export - Экспорт всех заметок в файл
-/note_stats - Статистика активности за неделю
+/note_export [txt|csv|jsonl] [gz] - Экспорт всех заметок в файл
+/note_stats [week|month|all] - Статистика активности
 /models - Показать доступные модели
 /model <id> - Выбрать активную модель
+/model auto - Выбирать самую быструю модель автоматически
 /ask <вопрос> - Задать вопрос ИИ
+/ask_cancel - Отменить вопросы, ждущие в очереди
+/ask_reset - Забыть историю разговора с ИИ
 
 📝 Лимит: {MAX_NOTES_PER_USER} заметок на пользователя
 """
@@ -53,43 +83,86 @@ def help_cmd(message):
 
 @bot.message_handler(commands=['note_add'])
 def note_add(message):
-    # Проверяем лимит заметок
     user_id = message.from_user.id
-    user_notes = list_notes(user_id)
+    text = message.text.replace('/note_add', '').strip()
+    if not text:
+        bot.reply_to(message, "Ошибка: Укажите текст заметки.")
+        return
 
-    if len(user_notes) >= MAX_NOTES_PER_USER:
+    # Проверка лимита и вставка — одной транзакцией
+    note_id, count = add_note_limited(user_id, text, MAX_NOTES_PER_USER)
+    if note_id is None:
         bot.reply_to(
             message,
             f"❌ Достигнут лимит заметок! Максимум {MAX_NOTES_PER_USER} заметок на пользователя.\n"
-            f"У вас уже {len(user_notes)} заметок. Удалите некоторые заметки чтобы добавить новые."
+            f"У вас уже {count} заметок. Удалите некоторые заметки чтобы добавить новые."
         )
         return
 
-    text = message.text.replace('/note_add', '').strip()
-    if not text:
-        bot.reply_to(message, "Ошибка: Укажите текст заметки.")
-        return
-
-    note_id = add_note(user_id, text)
     bot.reply_to(
         message,
         f"✅ Заметка #{note_id} добавлена: {text}\n"
-        f"📊 Статистика: {len(user_notes) + 1}/{MAX_NOTES_PER_USER} заметок"
+        f"📊 Статистика: {count}/{MAX_NOTES_PER_USER} заметок"
     )
 
 
 @bot.message_handler(commands=['note_list'])
 def note_list(message):
-    user_id = message.from_user.id
-    user_notes = list_notes(user_id)
-
-    if not user_notes:
-        bot.reply_to(message, "Заметок пока нет.")
+    text, kb = _notes_page_view(message.from_user.id)
+    bot.reply_to(message, text, reply_markup=kb)
+
+
+def _notes_page_view(user_id: int, before_id: int | None = None,
+                     after_id: int | None = None) -> tuple[str, types.InlineKeyboardMarkup | None]:
+    rows, has_older, has_newer = notes_page(user_id, before_id=before_id, after_id=after_id,
+                                            limit=NOTES_PAGE_SIZE)
+    if not rows:
+        return "Заметок пока нет.", None
+
+    def short(t: str) -> str:
+        return t if len(t) <= NOTE_PREVIEW_CHARS else t[:NOTE_PREVIEW_CHARS] + "…"
+
+    response = f"📝 Ваши заметки ({count_notes(user_id)}/{MAX_NOTES_PER_USER}):\n" + "\n".join(
+        [f"{note['id']}: {short(note['text'])}" for note in rows])
+    # notes:<владелец>:<направление>:<курсор — id крайней заметки страницы>; callback_data ≤ 64 байт
+    buttons = []
+    if has_newer:
+        buttons.append(types.InlineKeyboardButton("⬅️ Новее", callback_data=f"notes:{user_id}:n:{rows[0]['id']}"))
+    if has_older:
+        buttons.append(types.InlineKeyboardButton("Старше ➡️", callback_data=f"notes:{user_id}:o:{rows[-1]['id']}"))
+    kb = None
+    if buttons:
+        kb = types.InlineKeyboardMarkup()
+        kb.row(*buttons)
+    return response, kb
+
+
+@bot.callback_query_handler(func=lambda c: (c.data or "").startswith("notes:"))
+def on_notes_page(c):
+    parts = c.data.split(":")
+    if len(parts) != 4 or not parts[3].isdigit() or parts[2] not in ("n", "o"):
+        bot.answer_callback_query(c.id, "Список устарел — откройте /note_list заново.")
         return
+    _, owner, direction, cursor = parts
+    # в группе кнопки видят все: листать список может только тот, кто его открыл.
+    # Заметки всё равно берутся по c.from_user.id, владелец в callback_data — только для этой проверки
+    if owner != str(c.from_user.id):
+        bot.answer_callback_query(c.id, "Это чужой список заметок. Откройте свой: /note_list", show_alert=True)
+        return
+    cursor = int(cursor)
+    text, kb = _notes_page_view(c.from_user.id,
+                                before_id=cursor if direction == "o" else None,
+                                after_id=cursor if direction == "n" else None)
+    bot.answer_callback_query(c.id)
+    try:
+        bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
+    except telebot.apihelper.ApiTelegramException:
+        pass  # «message is not modified» при двойном нажатии
 
-    response = f"📝 Ваши заметки ({len(user_notes)}/{MAX_NOTES_PER_USER}):\n" + "\n".join(
-        [f"{note['id']}: {note['text']}" for note in user_notes])
-    bot.reply_to(message, response)
+
+def _highlight(snippet: str) -> str:
+    # экранируем текст заметки и превращаем маркеры совпадений из db.find_notes в <b>...</b>
+    return html.escape(snippet).replace(SNIPPET_OPEN, "<b>").replace(SNIPPET_CLOSE, "</b>")
 
 
 @bot.message_handler(commands=['note_find'])
@@ -107,8 +180,8 @@ def note_find(message):
         return
 
     response = f"🔍 Найденные заметки ({len(found_notes)}):\n" + "\n".join(
-        [f"{note['id']}: {note['text']}" for note in found_notes])
-    bot.reply_to(message, response)
+        [f"{note['id']}: {_highlight(note['snippet'])}" for note in found_notes])
+    bot.reply_to(message, response, parse_mode="HTML")
 
 
 @bot.message_handler(commands=['note_edit'])
@@ -132,11 +205,10 @@ def note_edit(message):
         bot.reply_to(message, f"Ошибка: Заметка #{note_id} не найдена или у вас нет прав для её изменения.")
         return
 
-    user_notes = list_notes(user_id)
     bot.reply_to(
         message,
         f"✏️ Заметка #{note_id} изменена на: {new_text}\n"
-        f"📊 Статистика: {len(user_notes)}/{MAX_NOTES_PER_USER} заметок"
+        f"📊 Статистика: {count_notes(user_id)}/{MAX_NOTES_PER_USER} заметок"
     )
 
 
@@ -160,19 +232,17 @@ def note_del(message):
         bot.reply_to(message, f"Ошибка: Заметка #{note_id} не найдена или у вас нет прав для её удаления.")
         return
 
-    user_notes = list_notes(user_id)
     bot.reply_to(
         message,
         f"🗑️ Заметка #{note_id} удалена.\n"
-        f"📊 Статистика: {len(user_notes)}/{MAX_NOTES_PER_USER} заметок"
+        f"📊 Статистика: {count_notes(user_id)}/{MAX_NOTES_PER_USER} заметок"
     )
 
 
 @bot.message_handler(commands=['note_count'])
 def note_count(message):
     user_id = message.from_user.id
-    user_notes = list_notes(user_id)
-    count = len(user_notes)
+    count = count_notes(user_id)
 
     if count >= MAX_NOTES_PER_USER:
         status = "❌ Лимит достигнут!"
@@ -194,92 +264,51 @@ def note_count(message):
 @bot.message_handler(commands=['note_export'])
 def note_export(message):
     user_id = message.from_user.id
-    user_notes = list_notes(user_id)
+    args = message.text.replace('/note_export', '', 1).lower().split()
+    fmt = next((a for a in args if a in FORMATS), "txt")
+    compress = "gz" in args or "gzip" in args
+    if any(a not in FORMATS + ("gz", "gzip") for a in args):
+        bot.reply_to(message, "Использование: /note_export [txt|csv|jsonl] [gz]")
+        return
 
-    if not user_notes:
+    if not count_notes(user_id):
         bot.reply_to(message, "У вас нет заметок для экспорта.")
         return
 
-    # Создаем имя файла с timestamp для уникальности
-    timestamp = int(time.time())
-    filename = f"notes_{user_id}_{timestamp}.txt"
-
     try:
-        # Создаем содержимое файла
-        file_content = f"Ваши заметки (экспорт от {time.strftime('%Y-%m-%d %H:%M:%S')})\n"
-        file_content += f"Всего заметок: {len(user_notes)}/{MAX_NOTES_PER_USER}\n"
-        file_content += "=" * 50 + "\n\n"
-
-        for note in user_notes:
-            file_content += f"Заметка #{note['id']}:\n"
-            file_content += f"{note['text']}\n"
-            file_content += "-" * 30 + "\n"
-
-        # Записываем в файл
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(file_content)
-
-        # Отправляем файл пользователю
-        with open(filename, 'rb') as f:
+        # файл собирается потоком с курсора в памяти/временном файле ОС — рабочая папка не трогается
+        f, filename, n = export_notes(user_id, fmt, compress)
+        with f:
             bot.send_document(
                 message.chat.id,
                 f,
-                caption=f"📁 Ваши заметки ({len(user_notes)}/{MAX_NOTES_PER_USER} шт.)",
-                visible_file_name="your_notes.txt"
+                caption=f"📁 Ваши заметки ({n} шт.)",
+                visible_file_name=filename
             )
-
-        # Удаляем временный файл
-        os.remove(filename)
-
     except Exception as e:
         bot.reply_to(message, f"Ошибка при экспорте заметок: {str(e)}")
-        # Пытаемся удалить файл в случае ошибки
-        if os.path.exists(filename):
-            try:
-                os.remove(filename)
-            except:
-                pass
 
 
 @bot.message_handler(commands=['note_stats'])
 def note_stats(message):
     user_id = message.from_user.id
-    user_notes = list_notes(user_id)
+    arg = message.text.replace('/note_stats', '', 1).strip().lower() or "week"
+    if arg not in STATS_RANGES:
+        bot.reply_to(message, "Использование: /note_stats [week|month|all]")
+        return
 
-    if not user_notes:
+    total_notes = count_notes(user_id)
+    if not total_notes:
         bot.reply_to(message, "У вас пока нет заметок для статистики.")
         return
 
-    # Получаем даты создания заметок (предполагаем, что в базе есть поле created_at)
-    # Если в вашей базе нет created_at, нужно будет адаптировать этот код
-    dates = []
-    for note in user_notes:
-        # Если в note есть created_at, используем его, иначе используем текущее время
-        if 'created_at' in note:
-            dates.append(note['created_at'])
-        else:
-            # Для демонстрации - случайные даты за последнюю неделю
-            days_ago = len(dates) % 7
-            dates.append(datetime.now() - timedelta(days=days_ago))
-
-    # Считаем активность по дням недели
-    week_activity = [0] * 7  # 0 = понедельник, 6 = воскресенье
-
-    for date in dates:
-        if isinstance(date, str):
-            # Если дата в строковом формате, преобразуем в datetime
-            try:
-                date_obj = datetime.fromisoformat(date.replace('Z', '+00:00'))
-            except:
-                date_obj = datetime.now()
-        else:
-            date_obj = date
-
-        weekday = date_obj.weekday()  # 0 = понедельник, 6 = воскресенье
-        week_activity[weekday] += 1
+    # гистограммы считает SQLite по таблице note_daily (даты в UTC, как created_at)
+    days = STATS_RANGES[arg]
+    activity = note_activity(user_id, days)
+    week_activity = activity["weekday"]  # 0 = понедельник, 6 = воскресенье
 
     # Создаем ASCII гистограмму
-    max_activity = max(week_activity) if week_activity else 1
+    max_activity = max(week_activity) or 1
     chart_height = 10
 
     # Названия дней недели
@@ -292,7 +321,7 @@ def note_stats(message):
     for level in range(chart_height, 0, -1):
         line = ""
         for day_activity in week_activity:
-            bar_height = (day_activity / max_activity) * chart_height if max_activity > 0 else 0
+            bar_height = (day_activity / max_activity) * chart_height
             if bar_height >= level:
                 line += " ██ "
             else:
@@ -307,7 +336,8 @@ def note_stats(message):
         values_line += f" {week_activity[i]:2d}"
 
     # Собираем всю визуализацию
-    stats_text = "📊 Ваша активность за неделю:\n\n"
+    titles = {"week": "за неделю", "month": "за месяц", "all": "за всё время"}
+    stats_text = f"📊 Ваша активность {titles[arg]}:\n\n"
 
     # Добавляем гистограмму
     for line in chart_lines:
@@ -316,13 +346,27 @@ def note_stats(message):
     stats_text += days_line + "\n"
     stats_text += values_line + "\n\n"
 
+    # По дням (за всё время — по месяцам): пустые дни тоже показываем
+    counts = dict(activity["buckets"])
+    if days is not None:
+        today = datetime.now(timezone.utc).date()
+        labels = [(today - timedelta(days=d)).isoformat() for d in range(days - 1, -1, -1)]
+    else:
+        labels = [b for b, _ in activity["buckets"]]
+    peak = max(counts.values(), default=0) or 1
+    stats_text += "🗓 По дням:\n" if days is not None else "🗓 По месяцам:\n"
+    for label in labels:
+        n = counts.get(label, 0)
+        stats_text += f"{label} {'█' * round(n / peak * 12):<12} {n}\n"
+    stats_text += "\n"
+
     # Общая статистика
-    total_notes = len(user_notes)
-    avg_per_day = total_notes / 7
-    most_active_day = days_ru[week_activity.index(max(week_activity))] if week_activity else "нет данных"
+    range_total = activity["total"]
+    avg_per_day = range_total / activity["span_days"]
+    most_active_day = days_ru[week_activity.index(max(week_activity))] if range_total else "нет данных"
 
     stats_text += f"📈 Общая статистика:\n"
-    stats_text += f"• Всего заметок: {total_notes}\n"
+    stats_text += f"• Всего заметок: {total_notes} (за период: {range_total})\n"
     stats_text += f"• В среднем в день: {avg_per_day:.1f}\n"
     stats_text += f"• Самый активный день: {most_active_day}\n"
     stats_text += f"• Лимит использования: {total_notes}/{MAX_NOTES_PER_USER} ({total_notes / MAX_NOTES_PER_USER * 100:.1f}%)\n\n"
@@ -335,7 +379,7 @@ def note_stats(message):
     else:
         stats_text += "💪 Хорошая работа! Можно добавить еще немного заметок."
 
-    bot.reply_to(message, stats_text)
+    bot.reply_to(message, stats_text[:TG_TEXT_LIMIT])
 
 
 @bot.message_handler(commands=["models"])
@@ -348,7 +392,7 @@ def cmd_models(message: types.Message) -> None:
     for m in items:
         star = "*" if m["active"] else " "
         lines.append(f"{star} {m['id']}. {m['label']} [{m['key']}]")
-    lines.append("\nАктивировать: /model <ID>")
+    lines.append("\nАктивировать: /model <ID>, автовыбор: /model auto")
     bot.reply_to(message, "\n".join(lines))
 
 
@@ -356,29 +400,169 @@ def cmd_models(message: types.Message) -> None:
 def cmd_model(message: types.Message) -> None:
     arg = message.text.replace("/model", "", 1).strip()
     if not arg:
+        if get_routing_mode() == "auto":
+            bot.reply_to(message, _auto_status())
+            return
         active = get_active_model()
-        bot.reply_to(message, f"Текущая активная модель: {active['label']} [{active['key']}]\n(сменить: /model <ID> или /models)")
+        bot.reply_to(message, f"Текущая активная модель: {active['label']} [{active['key']}]\n(сменить: /model <ID>, /model auto или /models)")
+        return
+    if arg.lower() == "auto":
+        set_routing_mode("auto")
+        bot.reply_to(message, "Включён автовыбор модели.\n" + _auto_status())
         return
     if not arg.isdigit():
-        bot.reply_to(message, "Использование: /model <ID из /models>")
+        bot.reply_to(message, "Использование: /model <ID из /models> или /model auto")
         return
     try:
         active = set_active_model(int(arg))
+        set_routing_mode("manual")
         bot.reply_to(message, f"Активная модель переключена: {active['label']} [{active['key']}]")
     except ValueError:
         bot.reply_to(message, "Неизвестный ID модели. Сначала /models")
 
 
-def _build_messages(user_id: int, user_text: str) -> list[dict]:
-    system = (
-        f"Ты отвечаешь кратко и по-существу.\n"
-        "Правила:\n"
-        "1) Технические ответы давай корректно и по пунктам.\n"
-    )
-    return [
-        {"role": "system", "content": system},
-        {"role": "user", "content": user_text},
-    ]
+def _auto_models() -> list[str]:
+    return llm_autoroute.allowed([m["key"] for m in list_models()])
+
+
+def _route_model() -> str:
+    """Модель для очередного /ask: активная или, в режиме auto, самая быстрая здоровая."""
+    active = get_active_model()["key"]
+    if get_routing_mode() != "auto":
+        return active
+    return llm_autoroute.router.choose(_auto_models(), active)
+
+
+def _auto_status() -> str:
+    stats = llm_autoroute.router.snapshot()
+    # не через _route_model(): тот может вернуть модель разовой разведки
+    current = llm_autoroute.router.current or llm_autoroute.router.choose(_auto_models(), get_active_model()["key"])
+    lines = [f"Режим: авто, сейчас отвечает {current}"]
+    for key in _auto_models():
+        h = stats.get(key)
+        if h is None:
+            lines.append(f"• {key}: нет данных")
+        else:
+            mark = "" if h["healthy"] else " (выключена)"
+            lines.append(f"• {key}: ~{h['latency_ms']} мс, ошибки {h['error_rate'] * 100:.0f}%{mark}")
+    lines.append("(вернуть ручной выбор: /model <ID>)")
+    return "\n".join(lines)
+
+
+def _build_messages(user_id: int, user_text: str, model_key: str | None = None) -> list[dict]:
+    # системный промпт + история в пределах бюджета токенов модели + текущий вопрос
+    return chat_memory.build_messages(user_id, user_text, model_key)
+
+
+class _StreamingReply:
+    """
+    Ответ, который растёт по мере прихода токенов: редактируем последнее сообщение
+    не чаще раза в STREAM_EDIT_INTERVAL_S, а при переполнении начинаем следующее.
+    """
+
+    def __init__(self, message: types.Message, placeholder: str = "⏳ Думаю…"):
+        self.chat_id = message.chat.id
+        self.pages = [""]
+        self.msg_ids = [bot.reply_to(message, placeholder).message_id]
+        self.shown = [placeholder]
+        self.last_edit = 0.0
+
+    def _render(self, i: int) -> bool:
+        text = self.pages[i] or "…"
+        if text == self.shown[i]:
+            return True  # Telegram отвечает ошибкой на «message is not modified»
+        try:
+            bot.edit_message_text(text, self.chat_id, self.msg_ids[i])
+        except telebot.apihelper.ApiTelegramException as e:
+            # 429 за частые правки, сообщение удалено и т.п. — пропускаем эту правку,
+            # shown не меняем: следующий тик попробует ещё раз с более свежим текстом
+            log.info("Streaming edit skipped: %s", e)
+            return False
+        self.shown[i] = text
+        return True
+
+    def _send(self, text: str) -> None:
+        try:
+            bot.send_message(self.chat_id, text)
+        except telebot.apihelper.ApiTelegramException as e:
+            log.warning("Streaming reply lost: %s", e)
+
+    def append(self, delta: str) -> None:
+        self.pages[-1] += delta
+        while len(self.pages[-1]) > TG_TEXT_LIMIT:
+            head, tail = self.pages[-1][:TG_TEXT_LIMIT], self.pages[-1][TG_TEXT_LIMIT:]
+            self.pages[-1] = head
+            self._render(len(self.pages) - 1)
+            self.pages.append(tail)
+            self.msg_ids.append(bot.send_message(self.chat_id, tail[:TG_TEXT_LIMIT] or "…").message_id)
+            self.shown.append(tail[:TG_TEXT_LIMIT] or "…")
+        now = time.monotonic()
+        if now - self.last_edit >= STREAM_EDIT_INTERVAL_S:
+            self._render(len(self.pages) - 1)
+            self.last_edit = now
+
+    def finish(self, footer: str) -> None:
+        # последняя правка — следующего тика не будет: если она не прошла, досылаем новым сообщением
+        if len(self.pages[-1]) + len(footer) <= TG_TEXT_LIMIT:
+            self.pages[-1] += footer
+            if not self._render(len(self.pages) - 1):
+                self._send(self.pages[-1])
+        else:
+            if not self._render(len(self.pages) - 1):
+                self._send(self.pages[-1])
+            self._send(footer.strip())
+
+    def fail(self, text: str) -> None:
+        # вызывается из обработчиков ошибок — сам исключений не бросает
+        if self.pages[-1]:
+            self._render(len(self.pages) - 1)
+            self._send(text)
+        else:
+            self.pages[-1] = text
+            if not self._render(len(self.pages) - 1):
+                self._send(text)
+
+
+def _reply_pages(message: types.Message, text: str, footer: str) -> None:
+    # длинный ответ — несколькими сообщениями, подпись к последнему
+    text = text + footer
+    for i in range(0, len(text), TG_TEXT_LIMIT):
+        bot.reply_to(message, text[i:i + TG_TEXT_LIMIT])
+
+
+def _model_chain(active_key: str) -> list[str]:
+    # активная модель первой, дальше — остальные из реестра по порядку (запасные);
+    # в режиме auto запасные — разрешённые модели от быстрых к медленным
+    if get_routing_mode() == "auto":
+        rest = llm_autoroute.router.rank(k for k in _auto_models() if k != active_key)
+    else:
+        rest = [m["key"] for m in list_models() if m["key"] != active_key]
+    return [active_key] + rest
+
+
+def _ask_streaming(message: types.Message, msgs: list[dict], model_key: str, flight_key: str | None) -> str | None:
+    reply = _StreamingReply(message)
+    parts = []
+    try:
+        stream = FallbackStream(msgs, _model_chain(model_key), temperature=ASK_TEMPERATURE, max_tokens=ASK_MAX_TOKENS)
+        for delta in stream:
+            parts.append(delta)
+            reply.append(delta)
+        text = "".join(parts).strip()
+        t = last_timing()
+        inflight.end(flight_key, result=(text, t["total_ms"], stream.model))
+        if flight_key is not None:
+            response_cache.put(model_key, msgs, ASK_TEMPERATURE, ASK_MAX_TOKENS, text, stream.model)
+        ttft = f"первый токен {t['ttft_ms']} мс; " if t.get("ttft_ms") is not None else ""
+        reply.finish(f"\n\n({ttft}всего {t['total_ms']} мс; модель: {stream.model})")
+        return text
+    except OpenRouterError as e:
+        inflight.end(flight_key, error=e)
+        reply.fail(f"Ошибка: {e}")
+    except Exception as e:
+        inflight.end(flight_key, error=e)
+        reply.fail("Непредвиденная ошибка.")
+    return None
 
 
 @bot.message_handler(commands=["ask"])
@@ -388,19 +572,135 @@ def cmd_ask(message: types.Message) -> None:
         bot.reply_to(message, "Использование: /ask <вопрос>")
         return
 
-    msgs = _build_messages(message.from_user.id, q[:600])
-    model_key = get_active_model()["key"]
+    try:
+        position = ask_jobs.submit(message.from_user.id, lambda: _answer_ask(message, q))
+    except QueueFullError:
+        bot.reply_to(message, "Слишком много вопросов в очереди. Попробуйте чуть позже.")
+        return
+    if position:
+        bot.reply_to(message, f"⏳ Вопрос в очереди, позиция {position}. Отменить: /ask_cancel")
+
+
+@bot.message_handler(commands=["llm_stats"])
+def cmd_llm_stats(message: types.Message) -> None:
+    if message.from_user.id not in ADMIN_IDS:
+        bot.reply_to(message, "Команда доступна только администраторам.")
+        return
+    s = llm_metrics.summary()
+    lines = [f"LLM за последние {s['window']} вызовов (всего {s['totals']['calls']}, ошибок {s['totals']['errors']}):"]
+    for model, m in s["models"].items():
+        lines.append(
+            f"• {model}: {m['upstream']} upstream, ошибки {m['error_rate'] * 100:.0f}%, "
+            f"p50/p95/p99 {m['p50_ms']}/{m['p95_ms']}/{m['p99_ms']} мс, первый байт p50 {m['ttfb_p50_ms']} мс, "
+            f"токены {m['prompt_tokens']}+{m['completion_tokens']}, "
+            f"кэш {m['cached']}, склейка {m['coalesced']}, fallback {m['fallback']}"
+        )
+        if m["connect_avg_ms"] is not None:
+            lines.append(
+                f"  соединения: из пула {m['reused']}, новых {m['new_connections']}, "
+                f"в среднем рукопожатие {m['connect_avg_ms']} мс против модели {m['model_avg_ms']} мс"
+            )
+    c, f = response_cache.stats(), inflight.stats()
+    lines.append(
+        f"\nКэш ответов: попаданий {c['memory_hits']} из памяти и {c['db_hits']} из БД, "
+        f"промахов {c['misses']} (доля {c['hit_rate'] * 100:.0f}%), записей в памяти {c['memory_entries']}, "
+        f"вытеснено {c['evicted']}; склейка: вызовов {f['upstream_calls']}, присоединилось {f['coalesced']}, "
+        f"сейчас в работе {f['in_flight']}"
+    )
+    p = pool_stats()
+    lines.append(
+        f"\nHTTP-пул: запросов {p['requests']}, новых соединений {p['new_connections']} "
+        f"(рукопожатия всего {p['handshake_ms']} мс), сбросов пула {p['resets']}"
+    )
+    path = llm_metrics.write_snapshot()
+    if path:
+        lines.append(f"\nСнимок: {path}")
+    bot.reply_to(message, "\n".join(lines)[:TG_TEXT_LIMIT])
+
+
+@bot.message_handler(commands=["ask_reset"])
+def cmd_ask_reset(message: types.Message) -> None:
+    chat_memory.forget(message.from_user.id)
+    bot.reply_to(message, "История разговора очищена.")
 
+
+@bot.message_handler(commands=["ask_cancel"])
+def cmd_ask_cancel(message: types.Message) -> None:
+    n = ask_jobs.cancel(message.from_user.id)
+    if n:
+        bot.reply_to(message, f"Отменено вопросов: {n}")
+    else:
+        bot.reply_to(message, "В очереди нет ваших вопросов (уже выполняющийся отменить нельзя).")
+
+
+def _answer_ask(message: types.Message, q: str) -> None:
+    q = q[:600]
+    model_key = _route_model()
+    msgs = _build_messages(message.from_user.id, q, model_key)
+    answer = _answer_messages(message, msgs, model_key)
+    if answer:
+        chat_memory.remember(message.from_user.id, q, answer)
+
+
+def _answer_messages(message: types.Message, msgs: list[dict], model_key: str) -> str | None:
+    """Отвечает пользователю; вернёт текст ответа (для истории) или None при ошибке."""
+    if chat_memory.has_history(msgs):
+        # с историей промпт уникален для пользователя: кэш и склейка не сработают.
+        # flight_key=None — inflight.end() с неизвестным ключом ничего не делает
+        flight_key, fut, leader = None, None, True
+    else:
+        cached = response_cache.get(model_key, msgs, ASK_TEMPERATURE, ASK_MAX_TOKENS)
+        if cached is not None:
+            cached, answered_by = cached
+            llm_metrics.record(answered_by, 200, 0, cached=True)
+            _reply_pages(message, cached, f"\n\n(из кэша; модель: {answered_by})")
+            return cached
+        # такой же вопрос уже выполняется — ждём его ответ вместо второго вызова
+        flight_key = make_key(model_key, msgs, ASK_TEMPERATURE, ASK_MAX_TOKENS)
+        fut, leader = inflight.begin(flight_key)
     try:
-        text, ms = chat_once(msgs, model=model_key, temperature=0.2, max_tokens=400)
-        out = (text or "").strip()[:4000]          # не переполняем сообщение Telegram
-        bot.reply_to(message, f"{out}\n\n({ms} мс; модель: {model_key})")
+        if not leader:
+            # ждём не дольше, чем ведущий сам ждёт модели; зависший ведущий не держит нас вечно
+            try:
+                text, ms, used = fut.result(timeout=BUDGET_S)
+            except FutureTimeoutError:
+                # стриминговый ведущий ограничен бюджетом только до первого токена и может
+                # писать дольше — не отдаём ошибку, а спрашиваем модель сами, без склейки
+                log.info("Coalesced ask still running after %ss, asking separately", BUDGET_S)
+                flight_key = None
+            else:
+                llm_metrics.record(used, 200, ms, coalesced=True)
+                text = (text or "").strip()
+                _reply_pages(message, text, f"\n\n(общий запрос, {ms} мс; модель: {used})")
+                return text
+        try:
+            if ASK_STREAM:
+                return _ask_streaming(message, msgs, model_key, flight_key)
+            try:
+                text, ms, used = chat_with_fallback(msgs, _model_chain(model_key),
+                                                    temperature=ASK_TEMPERATURE, max_tokens=ASK_MAX_TOKENS)
+            except BaseException as e:
+                inflight.end(flight_key, error=e)
+                raise
+            inflight.end(flight_key, result=(text, ms, used))
+            text = (text or "").strip()
+            if flight_key is not None:
+                response_cache.put(model_key, msgs, ASK_TEMPERATURE, ASK_MAX_TOKENS, text, used)
+            _reply_pages(message, text, f"\n\n({ms} мс; модель: {used})")
+            return text
+        finally:
+            # ведущий обязан разбудить ожидающих, даже если упал раньше end() (повторный end — no-op)
+            inflight.end(flight_key, error=OpenRouterError(500, "Запрос прерван."))
     except OpenRouterError as e:
         bot.reply_to(message, f"Ошибка: {e}")
     except Exception:
         bot.reply_to(message, "Непредвиденная ошибка.")
+    return None
 
 
 if __name__ == "__main__":
     print("Бот запускается...")
-    bot.infinity_polling()
\ No newline at end of file
+    llm_metrics.start_snapshot_writer()
+    # пробы тратят запросы — гоняем их, только пока включён автовыбор
+    llm_autoroute.router.start_probes(lambda: _auto_models() if get_routing_mode() == "auto" else [])
+    run_bot(bot)  # polling или webhook — см. BOT_MODE в runmode.py
\ No newline at end of file
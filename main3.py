@@ -12,26 +12,39 @@ main.py — DailyZodiakBot (развлекательный контент без
   /signs                  — показать список знаков
 
 Рассылка:
-  - фоновый поток проверяет раз в минуту: кому отправить сейчас;
-  - условие: subscribed=1, notify_hour == now.hour, last_sent_date != today.
+  - фоновый поток спит до ближайшего часа, в котором есть подписчики (scheduler.py),
+    и просыпается раньше при смене знака/часа/подписки;
+  - условие: subscribed=1, notify_hour == now.hour, last_sent_date != today;
+  - пользователи забираются пачками в аренду (db.claim_due_users), поэтому
+    несколько экземпляров бота не шлют одно и то же дважды.
 """
 
 from __future__ import annotations
 import logging
-import threading
-import time
+import os
+import socket
 import hashlib
-from datetime import datetime, date
+import threading
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
 
 import telebot
 from telebot import types
 
 import db2 as db
-from config2 import TOKEN, DEFAULT_NOTIFY_HOUR
+from config2 import TOKEN, DEFAULT_NOTIFY_HOUR, BOT_THREADS
+from scheduler import HourlyScheduler
+from broadcast import Broadcaster, BroadcastReport
+from webhook import run_bot
 
 log = logging.getLogger(__name__)
 
-bot = telebot.TeleBot(TOKEN)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+CLAIM_BATCH = 500
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+
+bot = telebot.TeleBot(TOKEN, num_threads=BOT_THREADS)
 db.init_db()  # создаём схемы, если их нет
 
 # ---------- справочник знаков: канон, синонимы, эмодзи ----------
@@ -117,6 +130,54 @@ def make_daily_text(sign: str, for_date: date) -> str:
     )
 
 
+# ---------- кэш текстов: на каждый день всего 12 разных сообщений ----------
+class DailyTextCache:
+    """
+    Тексты на (sign, date): при первом обращении к дате рендерим сразу все 12 знаков,
+    дальше /today и рассылка берут готовую строку из памяти.
+    Храним не больше keep_days дат, вытесняя давно не запрошенную (сегодня, прогретое
+    «завтра» и, например, «вчера» у рассылки, догоняющей полночь).
+    """
+
+    def __init__(self, keep_days: int = 3):
+        self.keep_days = keep_days
+        self._by_date: OrderedDict[date, dict[str, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.renders = 0
+
+    def _lookup(self, day: date) -> tuple[dict[str, str], bool]:
+        """(тексты на дату, были ли они уже в кэше). Вызывать под self._lock."""
+        texts = self._by_date.get(day)
+        if texts is not None:
+            self._by_date.move_to_end(day)
+            return texts, True
+        texts = {s: make_daily_text(s, day) for s in CANON_SIGNS}
+        self.renders += len(texts)
+        self._by_date[day] = texts
+        while len(self._by_date) > self.keep_days:
+            self._by_date.popitem(last=False)
+        return texts, False
+
+    def warm(self, day: date) -> dict[str, str]:
+        with self._lock:
+            return self._lookup(day)[0]
+
+    def get(self, sign: str, day: date) -> str:
+        with self._lock:
+            texts, cached = self._lookup(day)
+            txt = texts.get(sign)
+            if txt is not None and cached:
+                self.hits += 1
+        if txt is None:
+            # знак вне справочника (старые данные) — рендерим без кэша
+            return make_daily_text(sign, day)
+        return txt
+
+
+daily_texts = DailyTextCache()
+
+
 # ---------- вспомогательные утилиты ----------
 def user_mention(m: types.Message) -> str:
     u = m.from_user
@@ -217,7 +278,7 @@ def cmd_today(message: types.Message) -> None:
     if not row or not row["sign"]:
         bot.reply_to(message, "Сначала /set_sign <знак>.")
         return
-    txt = make_daily_text(row["sign"], date.today())
+    txt = daily_texts.get(row["sign"], date.today())
     bot.send_message(message.chat.id, txt, parse_mode="Markdown")
 
 
@@ -231,31 +292,57 @@ def kb_pick_sign(message: types.Message) -> None:
 
 
 # ---------- планировщик ежедневной отправки ----------
-def scheduler_loop() -> None:
-    log.info("Scheduler started")
+def _send_daily(chat_id: int, text: str) -> None:
+    bot.send_message(chat_id, text, parse_mode="Markdown")
+
+
+broadcaster = Broadcaster(_send_daily, workers=BROADCAST_WORKERS, rate=BROADCAST_RATE)
+
+
+def send_due_batch(today: date, hour: int) -> BroadcastReport:
+    """Одна пачка: аренда → параллельная отправка → массовая отметка."""
+    today_str = today.strftime("%Y-%m-%d")
+    due = db.claim_due_users(today_str, hour, WORKER_ID, limit=CLAIM_BATCH)
+    report = broadcaster.run((u["user_id"], daily_texts.get(u["sign"], today)) for u in due)
+    # Отметить отправку за сегодня одним запросом (как и раньше — в том числе неудачные):
+    if due:
+        db.mark_sent_bulk([u["user_id"] for u in due], today_str, WORKER_ID)
+    return report
+
+
+def send_due_hour(today: date, hour: int) -> None:
+    total = BroadcastReport()
     while True:
-        now = datetime.now()               # время сервера
-        today_str = now.strftime("%Y-%m-%d")
-        hour = now.hour
-        try:
-            due = db.list_due_users(today_str, hour)
-            for u in due:
-                # Сгенерировать текст и отправить:
-                txt = make_daily_text(u["sign"], now.date())
-                try:
-                    bot.send_message(u["user_id"], txt, parse_mode="Markdown")
-                except Exception as e:
-                    log.warning("Send failed to %s: %r", u["user_id"], e)
-                # Отметить отправку за сегодня:
-                db.mark_sent_today(u["user_id"], today_str)
-        except Exception as e:
-            log.exception("Scheduler error: %r", e)
-        time.sleep(60)  # проверяем раз в минуту
+        r = send_due_batch(today, hour)
+        total.total += r.total
+        total.sent += r.sent
+        total.failed += r.failed
+        total.failed_ids += r.failed_ids
+        total.retries += r.retries
+        total.throttled_s += r.throttled_s
+        total.elapsed_s += r.elapsed_s
+        if r.total < CLAIM_BATCH or scheduler.stopping:
+            break
+    if total.total:
+        log.info("Broadcast %s %02d:00 done: %s", today, hour, total)
+    daily_texts.warm(today + timedelta(days=1))  # заранее готовим тексты на завтра
+
+
+scheduler = HourlyScheduler(send_due_hour, db.list_notify_hours)
+db.add_schedule_listener(scheduler.wake)
 
 
 def start_scheduler() -> None:
-    t = threading.Thread(target=scheduler_loop, name="daily-scheduler", daemon=True)
-    t.start()
+    scheduler.start()
+
+
+def stop_scheduler() -> None:
+    # ждём текущую пачку: пока Broadcaster её шлёт, отпущенные аренды подхватил бы
+    # другой воркер и отправил бы тем же пользователям второй раз
+    if scheduler.stop(timeout=CLAIM_BATCH / BROADCAST_RATE + 30):
+        db.release_claims(WORKER_ID)
+    else:
+        log.warning("Broadcast still running at shutdown; its claims are left to expire")
 
 
 # ---------- меню команд в клиенте (см. Л2) ----------
@@ -276,5 +363,8 @@ def setup_bot_commands() -> None:
 # ---------- точка входа ----------
 if __name__ == "__main__":
     setup_bot_commands()        # удобство для пользователей [oai_citation:8‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq)
-    start_scheduler()           # запускаем фоновую проверку
-    bot.infinity_polling(skip_pending=True)  # запуск long polling (паттерн Л2/Л3) [oai_citation:9‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq) [oai_citation:10‡L3.pdf](file-service://file-TzQZFVK22mksuAGPBby5ME)
\ No newline at end of file
+    start_scheduler()           # запускаем фоновую рассылку
+    try:
+        run_bot(bot, skip_pending=True)  # запуск long polling или webhook, см. BOT_MODE в runmode.py (паттерн Л2/Л3) [oai_citation:9‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq) [oai_citation:10‡L3.pdf](file-service://file-TzQZFVK22mksuAGPBby5ME)
+    finally:
+        stop_scheduler()
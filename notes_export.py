@@ -0,0 +1,78 @@
+"""
+notes_export.py — потоковый экспорт заметок в TXT / CSV / JSON Lines (+ gzip).
+
+Строки идут прямо с курсора db.iter_notes в SpooledTemporaryFile: до EXPORT_SPOOL_BYTES
+всё в памяти, дальше — во временном файле ОС (не в рабочей папке). Ни список заметок,
+ни весь текст выгрузки целиком в памяти не собираются.
+"""
+
+from __future__ import annotations
+import codecs
+import csv
+import gzip
+import json
+import os
+import tempfile
+import time
+from typing import IO
+
+from db import iter_notes, count_notes
+
+FORMATS = ("txt", "csv", "jsonl")
+EXPORT_SPOOL_BYTES = int(os.getenv("EXPORT_SPOOL_BYTES", str(1024 * 1024)))
+
+
+def _write_txt(out, user_id: int) -> int:
+    out.write(f"Ваши заметки (экспорт от {time.strftime('%Y-%m-%d %H:%M:%S')})\n")
+    out.write(f"Всего заметок: {count_notes(user_id)}\n")
+    out.write("=" * 50 + "\n\n")
+    n = 0
+    for note in iter_notes(user_id):
+        out.write(f"Заметка #{note['id']} ({note['created_at']}):\n{note['text']}\n{'-' * 30}\n")
+        n += 1
+    return n
+
+
+def _write_csv(out, user_id: int) -> int:
+    w = csv.writer(out)
+    w.writerow(["id", "created_at", "text"])
+    n = 0
+    for note in iter_notes(user_id):
+        w.writerow([note["id"], note["created_at"], note["text"]])
+        n += 1
+    return n
+
+
+def _write_jsonl(out, user_id: int) -> int:
+    n = 0
+    for note in iter_notes(user_id):
+        out.write(json.dumps({"id": note["id"], "created_at": note["created_at"], "text": note["text"]},
+                             ensure_ascii=False) + "\n")
+        n += 1
+    return n
+
+
+_WRITERS = {"txt": _write_txt, "csv": _write_csv, "jsonl": _write_jsonl}
+
+
+def export_notes(user_id: int, fmt: str = "txt", compress: bool = False) -> tuple[IO[bytes], str, int]:
+    """
+    (файл, имя для Telegram, число заметок). Файл открыт и перемотан в начало;
+    закрыть его должен вызывающий (временный файл на диске при этом удалится).
+    """
+    if fmt not in _WRITERS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        raw = gzip.GzipFile(fileobj=spool, mode="wb", mtime=0) if compress else spool
+        # CSV с BOM — иначе Excel показывает кириллицу «кракозябрами»
+        out = codecs.getwriter("utf-8-sig" if fmt == "csv" else "utf-8")(raw)
+        n = _WRITERS[fmt](out, user_id)
+        if compress:
+            raw.close()   # дописывает хвост gzip; сам spool остаётся открытым
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    name = f"notes_{time.strftime('%Y%m%d')}.{fmt}" + (".gz" if compress else "")
+    return spool, name, n
@@ -1,21 +1,38 @@
 from __future__ import annotations
-import os, time, requests
+import asyncio, json, os, threading, time, requests
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 load_dotenv()
 
-OPENROUTER_API = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_API = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+ASYNC_POOL_SIZE = int(os.getenv("OPENROUTER_ASYNC_POOL_SIZE", "100"))
+POOL_SIZE = int(os.getenv("OPENROUTER_POOL_SIZE", "10"))
+CONNECT_TIMEOUT_S = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))
 
 @dataclass
 class OpenRouterError(Exception):
     status: int
     msg: str
+    retry_after: float | None = None   # секунды из заголовка Retry-After (429/503)
     def __str__(self) -> str:
         return f"[{self.status}] {self.msg}"
 
+def _retry_after(headers) -> float | None:
+    value = headers.get("Retry-After")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None  # HTTP-дата вместо секунд — не разбираем, пусть решает backoff
+
+def _http_error(status: int, headers) -> OpenRouterError:
+    return OpenRouterError(status, _friendly(status), _retry_after(headers))
+
 def _friendly(status: int) -> str:
     return {
         400: "Неверный формат запроса.",
@@ -29,36 +46,277 @@ def _friendly(status: int) -> str:
         504: "Таймаут шлюза OpenRouter. Сервер не ответил вовремя. Повторите попытку позже.",
     }.get(status, "Сервис недоступен. Повторите попытку позже.")
 
-def chat_once(messages: List[Dict], *,
-              model: str,
-              temperature: float = 0.2,
-              max_tokens: int = 400,
-              timeout_s: int = 30) -> Tuple[str, int]:
+def _headers() -> Dict[str, str]:
     if not OPENROUTER_API_KEY:
         raise OpenRouterError(401, "Отсутствует OPENROUTER_API_KEY (.env).")
-    headers = {
+    return {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json",
     }
-    payload = {
+
+def _payload(messages: List[Dict], model: str, temperature: float, max_tokens: int) -> Dict:
+    return {
         "model": model,
         "messages": messages,
         "temperature": temperature,
         "max_tokens": max_tokens,
     }
+
+def _extract_text(data) -> str:
+    try:
+        return data["choices"][0]["message"]["content"]
+    except Exception:
+        raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+
+# ---------- keep-alive пул соединений requests + замер TCP/TLS-рукопожатия ----------
+_timing = threading.local()          # время connect() в текущем потоке
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "new_connections": 0, "handshake_ms": 0.0, "resets": 0}
+
+def _timed_connect(connect):
+    def wrapper(self):
+        t0 = time.perf_counter()
+        try:
+            return connect(self)
+        finally:
+            _timing.connect_ms = getattr(_timing, "connect_ms", 0.0) + (time.perf_counter() - t0) * 1000
+    return wrapper
+
+class _TimedHTTPConnection(HTTPConnection):
+    connect = _timed_connect(HTTPConnection.connect)
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    connect = _timed_connect(HTTPSConnection.connect)
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+def _make_session() -> requests.Session:
+    s = requests.Session()
+    # повторы делаем сами (или не делаем) — адаптер не должен молча переотправлять POST
+    adapter = _PooledAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0, pool_block=False)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _make_session()
+        return _session
+
+def reset_session() -> None:
+    """Закрывает все keep-alive соединения (после сетевой ошибки) — следующий запрос откроет новые."""
+    global _session
+    new = _make_session()
+    # сначала подменяем: параллельные запросы сразу берут новую сессию, а не ждут закрытия старой
+    with _session_lock:
+        old, _session = _session, new
+    with _stats_lock:
+        _stats["resets"] += 1
+    if old is not None:
+        old.close()
+
+def pool_stats() -> Dict:
+    with _stats_lock:
+        out = dict(_stats)
+    out["handshake_ms"] = round(out["handshake_ms"], 1)
+    return out
+
+def _set_last_timing(t0: float, **extra) -> None:
+    dt_ms = int((time.perf_counter() - t0) * 1000)
+    connect_ms = _timing.connect_ms
+    _timing.last = {"connect_ms": round(connect_ms, 1), "model_ms": round(dt_ms - connect_ms, 1),
+                    "total_ms": dt_ms, "reused": connect_ms == 0.0, **extra}
+
+def last_timing() -> Dict:
+    """
+    Разбивка последнего вызова в этом потоке: connect_ms (рукопожатие), model_ms, total_ms,
+    ttfb_ms/ttft_ms (первый байт/токен) и usage (токены из ответа, если провайдер прислал).
+    """
+    return dict(getattr(_timing, "last", {}))
+
+def chat_once(messages: List[Dict], *,
+              model: str,
+              temperature: float = 0.2,
+              max_tokens: int = 400,
+              timeout_s: int = 30,
+              connect_timeout_s: float = CONNECT_TIMEOUT_S) -> Tuple[str, int]:
+    headers = _headers()
+    payload = _payload(messages, model, temperature, max_tokens)
+    _timing.connect_ms = 0.0
     t0 = time.perf_counter()
+    ttfb_ms = None
+    usage = None
     try:
-        r = requests.post(OPENROUTER_API, json=payload, headers=headers, timeout=timeout_s)
+        r = get_session().post(OPENROUTER_API, json=payload, headers=headers,
+                               timeout=(connect_timeout_s, timeout_s))
         dt_ms = int((time.perf_counter() - t0) * 1000)
+        ttfb_ms = int(r.elapsed.total_seconds() * 1000)   # до заголовков ответа
+        with _stats_lock:
+            _stats["requests"] += 1
+            if _timing.connect_ms:
+                _stats["new_connections"] += 1
+                _stats["handshake_ms"] += _timing.connect_ms
         if r.status_code // 100 != 2:
-            raise OpenRouterError(r.status_code, _friendly(r.status_code))
+            raise _http_error(r.status_code, r.headers)
         try:
             data = r.json()
-            text = data["choices"][0]["message"]["content"]
         except Exception:
             raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
-        return text, dt_ms
+        usage = data.get("usage") if isinstance(data, dict) else None
+        return _extract_text(data), dt_ms
+    except requests.exceptions.ConnectTimeout:
+        reset_session()
+        raise OpenRouterError(408, f"Таймаут подключения ({connect_timeout_s}с). Проверьте соединение.")
     except requests.exceptions.Timeout:
         raise OpenRouterError(408, f"Таймаут запроса ({timeout_s}с). Проверьте соединение.")
     except requests.exceptions.ConnectionError:
-        raise OpenRouterError(503, "Ошибка подключения к OpenRouter. Проверьте интернет-соединение.")
\ No newline at end of file
+        reset_session()
+        raise OpenRouterError(503, "Ошибка подключения к OpenRouter. Проверьте интернет-соединение.")
+    finally:
+        _set_last_timing(t0, ttfb_ms=ttfb_ms, usage=usage)
+
+
+# ---------- потоковый ответ (SSE, "stream": true) ----------
+def chat_stream(messages: List[Dict], *,
+                model: str,
+                temperature: float = 0.2,
+                max_tokens: int = 400,
+                timeout_s: int = 30,
+                connect_timeout_s: float = CONNECT_TIMEOUT_S) -> Iterator[str]:
+    """
+    Генератор кусочков текста по мере прихода токенов.
+    После исчерпания last_timing() содержит ttft_ms (время до первого токена) и total_ms.
+    Ошибки — те же OpenRouterError, что и у chat_once (в том числе посреди потока).
+    """
+    headers = _headers()
+    payload = _payload(messages, model, temperature, max_tokens)
+    payload["stream"] = True
+    _timing.connect_ms = 0.0
+    t0 = time.perf_counter()
+    ttft_ms = None
+    usage = None
+    try:
+        with get_session().post(OPENROUTER_API, json=payload, headers=headers, stream=True,
+                                timeout=(connect_timeout_s, timeout_s)) as r:
+            if r.status_code // 100 != 2:
+                raise _http_error(r.status_code, r.headers)
+            for raw in r.iter_lines():
+                line = raw.decode("utf-8", errors="replace")
+                if not line.startswith("data:"):
+                    continue  # пустые строки-разделители и комментарии ": OPENROUTER PROCESSING"
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+                if "error" in chunk:
+                    status = int((chunk["error"] or {}).get("code") or 500)
+                    raise OpenRouterError(status, _friendly(status))
+                if chunk.get("usage"):
+                    usage = chunk["usage"]   # обычно приходит в последнем событии
+                if not chunk.get("choices"):
+                    continue
+                try:
+                    delta = chunk["choices"][0].get("delta", {}).get("content") or ""
+                except (KeyError, IndexError, AttributeError):
+                    raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+                if delta:
+                    if ttft_ms is None:
+                        ttft_ms = int((time.perf_counter() - t0) * 1000)
+                    yield delta
+    except requests.exceptions.ConnectTimeout:
+        reset_session()
+        raise OpenRouterError(408, f"Таймаут подключения ({connect_timeout_s}с). Проверьте соединение.")
+    except requests.exceptions.Timeout:
+        raise OpenRouterError(408, f"Таймаут запроса ({timeout_s}с). Проверьте соединение.")
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+        reset_session()
+        raise OpenRouterError(503, "Ошибка подключения к OpenRouter. Проверьте интернет-соединение.")
+    finally:
+        _set_last_timing(t0, ttft_ms=ttft_ms, usage=usage)
+
+
+# ---------- asyncio-вариант: один пул соединений aiohttp на event loop ----------
+_async_session = None
+_async_loop = None
+
+async def _get_async_session():
+    """Общая ClientSession (keep-alive, до ASYNC_POOL_SIZE соединений) для текущего event loop."""
+    global _async_session, _async_loop
+    try:
+        import aiohttp
+    except ImportError:
+        raise RuntimeError("Для chat_once_async нужен aiohttp: pip install aiohttp")
+    loop = asyncio.get_running_loop()
+    if _async_session is None or _async_session.closed or _async_loop is not loop:
+        # сначала подменяем, потом закрываем: пока идёт await close(), параллельные
+        # корутины уже должны получать новую сессию, а не закрывающуюся
+        old = _async_session
+        _async_loop = loop
+        _async_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, keepalive_timeout=60),
+        )
+        if old is not None and not old.closed:
+            # сессия от прежнего loop (повторный asyncio.run) — закрываем, иначе утекут сокеты
+            try:
+                await old.close()
+            except Exception:
+                pass   # прежний loop уже закрыт — его соединения всё равно мертвы
+    return _async_session
+
+async def close_async_session() -> None:
+    global _async_session, _async_loop
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+    _async_session = None
+    _async_loop = None
+
+async def chat_once_async(messages: List[Dict], *,
+                          model: str,
+                          temperature: float = 0.2,
+                          max_tokens: int = 400,
+                          timeout_s: int = 30) -> Tuple[str, int]:
+    """То же, что chat_once: (text, dt_ms) или OpenRouterError, но без блокировки потока."""
+    headers = _headers()
+    payload = _payload(messages, model, temperature, max_tokens)
+    session = await _get_async_session()
+    import aiohttp
+    t0 = time.perf_counter()
+    try:
+        async with session.post(OPENROUTER_API, json=payload, headers=headers,
+                                timeout=aiohttp.ClientTimeout(total=timeout_s)) as r:
+            if r.status // 100 != 2:
+                raise _http_error(r.status, r.headers)
+            try:
+                data = await r.json(content_type=None)
+            except (aiohttp.ClientPayloadError, ValueError):
+                raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+        dt_ms = int((time.perf_counter() - t0) * 1000)
+        return _extract_text(data), dt_ms
+    except asyncio.TimeoutError:
+        raise OpenRouterError(408, f"Таймаут запроса ({timeout_s}с). Проверьте соединение.")
+    except aiohttp.ClientConnectionError:
+        raise OpenRouterError(503, "Ошибка подключения к OpenRouter. Проверьте интернет-соединение.")
+    except aiohttp.ClientResponseError as e:
+        raise OpenRouterError(e.status, _friendly(e.status))
+    except aiohttp.ClientError:
+        raise OpenRouterError(502, "Некорректный ответ OpenRouter. Повторите попытку позже.")
@@ -0,0 +1,25 @@
+"""
+runmode.py — как бот получает апдейты: polling или webhook (см. webhook.py), и сколько потоков
+у обработчиков telebot.
+
+Только чтение переменных окружения, без побочных эффектов: модуль можно импортировать из любого
+бота (main.py, main2.py, main3.py), не настраивая логирование и не требуя TOKEN, как config2.py.
+"""
+
+from __future__ import annotations
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE: str = (os.getenv("BOT_MODE") or "polling").lower()
+BOT_THREADS = int(os.getenv("BOT_THREADS", "2"))             # потоки обработчиков telebot
+WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")              # публичный https-адрес; пусто — не регистрировать
+WEBHOOK_LISTEN: str = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+MODES = ("polling", "webhook")
@@ -0,0 +1,114 @@
+"""
+scheduler.py — событийный планировщик ежечасной рассылки.
+
+Вместо опроса раз в минуту:
+  - после очередного прогона считаем время следующего «непустого» часа
+    (по списку notify_hour из БД) и спим ровно до него; если прогон затянулся
+    и этот час уже наступил — запускаемся сразу;
+  - wake() будит раньше — его вызывают при смене знака/часа/подписки;
+  - stop() корректно завершает поток и сообщает, успел ли закончиться текущий прогон.
+
+Планировщик ничего не знает ни о Telegram, ни о SQL: ему передаются
+send_hour(day, hour) и due_hours() -> список часов 0..23.
+"""
+
+from __future__ import annotations
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterable
+
+log = logging.getLogger(__name__)
+
+
+class HourlyScheduler:
+    def __init__(self,
+                 send_hour: Callable[[date, int], object],
+                 due_hours: Callable[[], Iterable[int]],
+                 *,
+                 max_sleep_s: float = 900.0,
+                 now: Callable[[], datetime] = datetime.now):
+        self._send_hour = send_hour
+        self._due_hours = due_hours
+        # страховка: перечитываем расписание не реже, чем раз в max_sleep_s
+        # (перевод часов, просроченные аренды упавших воркеров)
+        self.max_sleep_s = max_sleep_s
+        self._now = now
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.runs = 0
+
+    # ---------- управление ----------
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="daily-scheduler", daemon=True)
+        self._thread.start()
+
+    def wake(self) -> None:
+        """Пересчитать расписание сейчас (изменились настройки пользователей)."""
+        self._wake.set()
+
+    @property
+    def stopping(self) -> bool:
+        """stop() уже вызван — долгий send_hour может закончить раньше, между пачками."""
+        return self._stopped.is_set()
+
+    def stop(self, timeout: float | None = 5.0) -> bool:
+        """Останавливает поток; False — текущий прогон не успел завершиться за timeout."""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return False
+            self._thread = None
+        return True
+
+    # ---------- расчёт следующего пробуждения ----------
+    def next_wake(self, now: datetime) -> datetime | None:
+        hours = sorted({int(h) for h in self._due_hours()})
+        if not hours:
+            return None
+        start_of_day = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=now.hour)
+        later = [h for h in hours if h > now.hour]
+        if later:
+            return start_of_day + timedelta(hours=later[0])
+        return start_of_day + timedelta(days=1, hours=hours[0])
+
+    def _sleep_until(self, target: datetime | None) -> None:
+        while not self._stopped.is_set():
+            if target is None:
+                self._wake.wait(self.max_sleep_s)
+                return
+            remaining = (target - self._now()).total_seconds()
+            if remaining <= 0:
+                return
+            if remaining > self.max_sleep_s:
+                self._wake.wait(self.max_sleep_s)
+                return
+            if self._wake.wait(remaining):
+                return
+            # таймер мог сработать чуть раньше границы часа — досыпаем остаток
+
+    # ---------- основной цикл ----------
+    def _run(self) -> None:
+        log.info("Scheduler started")
+        while not self._stopped.is_set():
+            # сбрасываем до прогона: изменения, пришедшие во время отправки, не потеряются
+            self._wake.clear()
+            now = self._now()
+            target = None
+            try:
+                self._send_hour(now.date(), now.hour)
+                self.runs += 1
+                # следующий час считаем от начала прогона: если рассылка перевалила за границу
+                # часа, его цель уже в прошлом и мы запустимся сразу, а не пропустим этот час
+                target = self.next_wake(now)
+            except Exception as e:
+                log.exception("Scheduler error: %r", e)
+                target = self._now() + timedelta(seconds=60)
+            log.debug("Scheduler sleeps until %s", target)
+            self._sleep_until(target)
+        log.info("Scheduler stopped")
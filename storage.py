@@ -0,0 +1,321 @@
+"""
+storage.py — общий движок хранения SQLite для db.py и db2.py.
+
+Вместо «новое подключение + три PRAGMA на каждый запрос» держим пул:
+  - читатели: ограниченный пул подключений (PRAGMA применяются один раз при создании,
+    query_only=ON защищает от случайной записи); подключение на время with-блока
+    принадлежит одному потоку;
+  - писатель: одно подключение под RLock — SQLite всё равно допускает только одного
+    писателя, так мы не толкаемся за блокировку внутри busy_timeout;
+  - счётчики: checkouts / hits / creates / waits / wait_ms — см. ConnectionPool.stats();
+  - WriteQueue: опциональная групповая фиксация — один поток-писатель собирает
+    операции в пачку и выполняет их одной транзакцией (один fsync WAL на пачку).
+
+Пулы разделяются по пути к файлу БД: db.py и db2.py, смотрящие в один bot.db,
+получают один и тот же ConnectionPool через get_pool().
+"""
+
+from __future__ import annotations
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_MS = 5000
+
+
+def _open(db_path: str, *, readonly: bool) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class ConnectionPool:
+    """Пул подключений к одному файлу SQLite: N читателей + один писатель."""
+
+    def __init__(self, db_path: str, max_readers: int = DEFAULT_POOL_SIZE):
+        self.db_path = db_path
+        self.max_readers = max(1, int(max_readers))
+        self._cond = threading.Condition()
+        self._idle: list[sqlite3.Connection] = []
+        self._all: list[sqlite3.Connection] = []
+        self._opening = 0   # зарезервировано мест под подключения, которые сейчас открываются
+        self._writer: sqlite3.Connection | None = None
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+        self._writer_owner: int | None = None   # ident потока, держащего писателя
+        self._closed = False
+        self._stats = {
+            "checkouts": 0, "hits": 0, "creates": 0,
+            "waits": 0, "wait_ms": 0.0,
+            "writer_checkouts": 0, "writer_waits": 0, "writer_wait_ms": 0.0,
+        }
+
+    # ---------- читатели ----------
+    def _acquire_reader(self) -> sqlite3.Connection:
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Пул подключений закрыт")
+            self._stats["checkouts"] += 1
+            if self._idle:
+                self._stats["hits"] += 1
+                return self._idle.pop()  # LIFO: самое «тёплое» подключение
+            if len(self._all) + self._opening < self.max_readers:
+                # резервируем место, а подключаемся уже без блокировки: открытие файла
+                # и PRAGMA не должны задерживать потоки, которые просто берут/отдают подключения
+                self._stats["creates"] += 1
+                self._opening += 1
+            else:
+                self._stats["waits"] += 1
+                t0 = time.perf_counter()
+                while not self._idle:
+                    self._cond.wait()
+                    if self._closed:
+                        raise RuntimeError("Пул подключений закрыт")
+                self._stats["wait_ms"] += (time.perf_counter() - t0) * 1000
+                return self._idle.pop()
+        try:
+            conn = _open(self.db_path, readonly=True)
+        except BaseException:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()  # место освободилось — ожидающий может попробовать сам
+            raise
+        with self._cond:
+            self._opening -= 1
+            if self._closed:
+                conn.close()
+                raise RuntimeError("Пул подключений закрыт")
+            self._all.append(conn)
+        return conn
+
+    def _release_reader(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            if self._closed:
+                conn.close()
+                return
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Подключение только для чтения. Результаты выбираем внутри with-блока."""
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            self._release_reader(conn)
+
+    # ---------- писатель ----------
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """
+        Единственное пишущее подключение. Внешний with фиксирует транзакцию
+        (commit при успехе, rollback при исключении); вложенные with в том же
+        потоке переиспользуют ту же транзакцию.
+        """
+        if not self._writer_lock.acquire(blocking=False):
+            t0 = time.perf_counter()
+            self._writer_lock.acquire()
+            with self._cond:
+                self._stats["writer_waits"] += 1
+                self._stats["writer_wait_ms"] += (time.perf_counter() - t0) * 1000
+        try:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Пул подключений закрыт")
+                self._stats["writer_checkouts"] += 1
+            if self._writer is None:   # под _writer_lock — второго открытия не будет
+                self._writer = _open(self.db_path, readonly=False)
+            conn = self._writer
+            self._writer_depth += 1
+            self._writer_owner = threading.get_ident()
+            try:
+                yield conn
+            except BaseException:
+                if self._writer_depth == 1 and conn.in_transaction:
+                    conn.rollback()
+                raise
+            else:
+                if self._writer_depth == 1 and conn.in_transaction:
+                    conn.commit()
+            finally:
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer_owner = None
+        finally:
+            self._writer_lock.release()
+
+    def owns_writer(self) -> bool:
+        """True, если текущий поток сейчас внутри writer(): ждать чужой записи ему нельзя."""
+        return self._writer_owner == threading.get_ident()
+
+    # ---------- служебное ----------
+    def stats(self) -> dict:
+        with self._cond:
+            out = dict(self._stats)
+            out["readers_open"] = len(self._all)
+            out["readers_idle"] = len(self._idle)
+            out["wait_ms"] = round(out["wait_ms"], 3)
+            out["writer_wait_ms"] = round(out["writer_wait_ms"], 3)
+        return out
+
+    def close(self) -> None:
+        with self._writer_lock, self._cond:
+            self._closed = True
+            for conn in self._idle:
+                conn.close()
+            self._all = [c for c in self._all if c not in self._idle]
+            self._idle.clear()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self._cond.notify_all()
+
+
+# ---------- групповая фиксация записей ----------
+WriteOp = Callable[..., Any]
+
+
+class WriteQueue:
+    """
+    Write-behind очередь: submit(op, *args) возвращает Future, который разрешится
+    результатом op(conn, *args). Поток-писатель набирает до max_batch операций
+    (или ждёт не дольше max_delay_ms после первой) и выполняет их одной транзакцией.
+    Каждая операция — в своём SAVEPOINT: ошибка одной не откатывает соседей.
+    """
+
+    def __init__(self, pool: ConnectionPool, max_batch: int = 64, max_delay_ms: float = 5.0):
+        self.pool = pool
+        self.max_batch = max(1, int(max_batch))
+        self.max_delay = max(0.0, max_delay_ms) / 1000
+        self._q: queue.Queue = queue.Queue()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._stats = {"ops": 0, "batches": 0, "errors": 0, "max_batch_seen": 0}
+        self._thread = threading.Thread(target=self._run, name="sqlite-write-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, op: WriteOp, *args) -> Future:
+        """
+        Поток, который держит pool.writer(), не должен ждать этот Future: поток-писатель
+        встанет за тем же RLock — взаимная блокировка. Такие вызывающие пишут сами (см. db._queue).
+        """
+        if self._closed:
+            raise RuntimeError("Очередь записи закрыта")
+        fut: Future = Future()
+        self._q.put((fut, op, args))
+        return fut
+
+    def _collect(self) -> list | None:
+        item = self._q.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._q.get(timeout=timeout) if timeout > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._q.put(None)  # стоп обработаем после текущей пачки
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            batch = [b for b in batch if b[0].set_running_or_notify_cancel()]
+            if batch:
+                self._execute(batch)
+
+    def _execute(self, batch: list) -> None:
+        results = []
+        try:
+            with self.pool.writer() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for fut, op, args in batch:
+                    conn.execute("SAVEPOINT wq_op")
+                    try:
+                        res = op(conn, *args)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO wq_op")
+                        conn.execute("RELEASE wq_op")
+                        results.append((fut, None, e))
+                    else:
+                        conn.execute("RELEASE wq_op")
+                        results.append((fut, res, None))
+        except Exception as e:
+            log.exception("Write batch failed: %r", e)
+            with self._stats_lock:
+                self._stats["errors"] += len(batch)
+            for fut, _, _ in batch:
+                fut.set_exception(e)
+            return
+        with self._stats_lock:
+            self._stats["ops"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["errors"] += sum(1 for _, _, e in results if e is not None)
+            self._stats["max_batch_seen"] = max(self._stats["max_batch_seen"], len(batch))
+        for fut, res, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["pending"] = self._q.qsize()
+        return out
+
+    def close(self, timeout: float | None = 5.0) -> None:
+        """Дописывает уже поставленные операции и останавливает поток-писатель."""
+        if self._closed:
+            return
+        self._closed = True
+        self._q.put(None)
+        self._thread.join(timeout)
+
+
+# ---------- реестр пулов по пути к БД ----------
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str, max_readers: int = DEFAULT_POOL_SIZE) -> ConnectionPool:
+    """Общий пул для файла db_path (создаётся при первом обращении)."""
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None or pool._closed:
+            pool = ConnectionPool(db_path, max_readers)
+            _pools[db_path] = pool
+        return pool
+
+
+def close_all() -> None:
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
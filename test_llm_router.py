@@ -0,0 +1,106 @@
+"""
+Тесты llm_router: пробный запрос half-open breaker-а не должен «залипать»,
+а 403/404 одной модели не должны обрывать цепочку запасных.
+
+    python -m pytest -q test_llm_router.py
+"""
+
+import time
+
+import pytest
+
+import llm_router
+from llm_router import OpenRouterError
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(llm_router, "_breakers", {})
+    monkeypatch.setattr(llm_router, "BACKOFF_BASE_S", 0.0)
+    yield
+
+
+def _half_open(model: str) -> llm_router.CircuitBreaker:
+    b = llm_router.breaker(model)
+    b.cooldown_s = 0
+    for _ in range(b.threshold):
+        b.failure()
+    assert b.state == "half-open"
+    assert b.allow()          # пробный запрос выдан — так же, как его берёт _chain
+    assert not b.allow()      # второй — нет
+    return b
+
+
+def _raise(err: BaseException):
+    def fn(_timeout):
+        raise err
+    return fn
+
+
+def _far() -> float:
+    return time.monotonic() + 60
+
+
+def test_terminal_error_releases_trial():
+    b = _half_open("m-400")
+    with pytest.raises(OpenRouterError):
+        llm_router._call_model("m-400", _raise(OpenRouterError(400, "bad")), _far())
+    assert b.allow()
+
+
+def test_budget_error_releases_trial():
+    b = _half_open("m-budget")
+    with pytest.raises(OpenRouterError) as e:
+        llm_router._call_model("m-budget", lambda t: "ok", time.monotonic())
+    assert e.value.status == 408
+    assert b.allow()
+
+
+def test_unexpected_exception_releases_trial():
+    b = _half_open("m-crash")
+    with pytest.raises(RuntimeError):
+        llm_router._call_model("m-crash", _raise(RuntimeError("boom")), _far())
+    assert b.allow()
+
+
+def test_success_closes_breaker():
+    b = _half_open("m-ok")
+    assert llm_router._call_model("m-ok", lambda t: "ok", _far(), record_success=False) == "ok"
+    assert b.state == "closed" and b.allow()
+
+
+def test_model_failure_reopens_breaker():
+    b = _half_open("m-500")
+    b.cooldown_s = 60
+    with pytest.raises(OpenRouterError):
+        llm_router._call_model("m-500", _raise(OpenRouterError(500, "down")), _far())
+    assert b.state == "open" and not b.allow()
+
+
+@pytest.mark.parametrize("status", [403, 404])
+def test_model_specific_errors_fall_through(monkeypatch, status):
+    calls = []
+
+    def fake_chat_once(messages, *, model, **kwargs):
+        calls.append(model)
+        if model == "first":
+            raise OpenRouterError(status, "model error")
+        return "answer", 5
+
+    monkeypatch.setattr(llm_router, "chat_once", fake_chat_once)
+    text, _, used = llm_router.chat_with_fallback([{"role": "user", "content": "q"}], ["first", "second"])
+    assert (text, used) == ("answer", "second")
+    assert calls == ["first", "second"]   # 403/404 не повторяем
+
+
+def test_request_error_stops_chain(monkeypatch):
+    calls = []
+
+    def fake_chat_once(messages, *, model, **kwargs):
+        calls.append(model)
+        raise OpenRouterError(400, "bad request")
+
+    monkeypatch.setattr(llm_router, "chat_once", fake_chat_once)
+    with pytest.raises(OpenRouterError):
+        llm_router.chat_with_fallback([{"role": "user", "content": "q"}], ["first", "second"])
+    assert calls == ["first"]
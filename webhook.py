@@ -0,0 +1,121 @@
+"""
+webhook.py — запуск бота через webhook вместо infinity_polling.
+
+Telegram сам присылает каждый апдейт POST-запросом; маленький встроенный HTTP-сервер
+  - принимает запросы только на WEBHOOK_PATH и только с верным заголовком
+    X-Telegram-Bot-Api-Secret-Token (сравнение за постоянное время);
+  - сразу отвечает 200, а апдейт кладёт в пул потоков обработчиков telebot
+    (process_new_updates при threaded=True), — медленный обработчик не держит соединение;
+  - отдаёт GET /healthz для балансировщика.
+
+TLS завершается на балансировщике/прокси. За балансировщиком можно держать несколько
+экземпляров: webhook регистрирует тот, у кого задан WEBHOOK_URL, остальные только слушают.
+Настройки — в runmode.py; по умолчанию BOT_MODE=polling и всё работает как раньше.
+"""
+
+from __future__ import annotations
+import hmac
+import logging
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telebot
+from telebot import types
+
+from runmode import (BOT_MODE, MODES, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                     WEBHOOK_MAX_CONNECTIONS)
+
+log = logging.getLogger(__name__)
+
+MAX_BODY = 1024 * 1024
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+_SECRET_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")   # ограничения Telegram на secret_token
+
+
+def _make_handler(bot: telebot.TeleBot, path: str, secret: str):
+    expected = secret.encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive: Telegram шлёт апдейты по открытым соединениям
+
+        def log_message(self, fmt, *args) -> None:
+            log.debug("webhook: " + fmt, *args)
+
+        def _reply(self, status: int, body: bytes = b"", *, close: bool = False) -> None:
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            if close:
+                # тело запроса не прочитано — его остаток нельзя принять за следующий запрос
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path == "/healthz":
+                self._reply(200, b"ok")
+            else:
+                self._reply(404)
+
+        def do_POST(self) -> None:
+            if self.path != path:
+                self._reply(404, close=True)
+                return
+            got = (self.headers.get(SECRET_HEADER) or "").encode()
+            if not hmac.compare_digest(got, expected):
+                self._reply(403, close=True)
+                return
+            # размер проверяем до чтения: без Content-Length (chunked) или с мусором в нём — 400
+            try:
+                length = int(self.headers.get("Content-Length", ""))
+            except ValueError:
+                length = 0
+            if length <= 0 or length > MAX_BODY:
+                self._reply(413 if length > MAX_BODY else 400, close=True)
+                return
+            try:
+                update = types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+            except (ValueError, KeyError, TypeError) as e:
+                log.warning("Bad webhook update: %r", e)
+                self._reply(400)
+                return
+            # отвечаем сразу: обработчики выполняются в пуле потоков telebot
+            self._reply(200)
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                log.exception("Webhook dispatch failed: %r", e)
+
+    return Handler
+
+
+def serve(bot: telebot.TeleBot, *, drop_pending: bool = False,
+          listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+          secret: str = WEBHOOK_SECRET, public_url: str = WEBHOOK_URL) -> None:
+    """Регистрирует webhook (если задан public_url) и обслуживает запросы до Ctrl+C."""
+    if not _SECRET_RE.match(secret or ""):
+        raise RuntimeError("Для webhook нужен WEBHOOK_SECRET: 1–256 символов A-Z, a-z, 0-9, _ и -")
+    if public_url:
+        bot.set_webhook(url=public_url.rstrip("/") + path, secret_token=secret,
+                        max_connections=WEBHOOK_MAX_CONNECTIONS, drop_pending_updates=drop_pending)
+        log.info("Webhook set: %s%s", public_url.rstrip("/"), path)
+    server = ThreadingHTTPServer((listen, port), _make_handler(bot, path, secret))
+    server.daemon_threads = True
+    log.info("Webhook server listening on %s:%s%s", listen, port, path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def run_bot(bot: telebot.TeleBot, *, skip_pending: bool = False) -> None:
+    """Точка входа для всех ботов: режим выбирается BOT_MODE из runmode.py."""
+    if BOT_MODE not in MODES:
+        raise RuntimeError("BOT_MODE должен быть polling или webhook")
+    if BOT_MODE == "webhook":
+        serve(bot, drop_pending=skip_pending)
+        return
+    # после работы в режиме webhook Telegram отвечает на getUpdates ошибкой 409 — снимаем его
+    bot.remove_webhook()
+    bot.infinity_polling(skip_pending=skip_pending)